@@ -4,12 +4,110 @@ import sys
 import pwd
 import click
 import signal
-import peewee
-import tempfile
-from subprocess import Popen
 
 
 
+def validate_size(ctx, param, value):
+    if value is None:
+        return None
+
+    from taskq.utils import parse_size
+    try:
+        return parse_size(value)
+    except ValueError:
+        raise click.BadParameter('expected a size such as 512M or 32G.')
+
+
+def validate_duration(ctx, param, value):
+    if value is None:
+        return None
+
+    from taskq.utils import parse_duration
+    try:
+        return parse_duration(value)
+    except ValueError:
+        raise click.BadParameter('expected a duration such as 90, 30m, 2h or 01:30:00.')
+
+
+def validate_array(ctx, param, value):
+    if value is None:
+        return None
+
+    try:
+        start, _, stop = value.partition('-')
+        start, stop = int(start), int(stop or start)
+    except ValueError:
+        raise click.BadParameter('expected a range of indexes such as 0-99.')
+    if stop < start:
+        raise click.BadParameter('the last index must not be lower than the first.')
+
+    return start, stop
+
+
+def validate_since(ctx, param, value):
+    if value is None:
+        return None
+
+    import datetime
+    from taskq.utils import parse_duration
+    try:
+        return datetime.datetime.fromisoformat(value)
+    except ValueError:
+        pass
+    try:
+        return datetime.datetime.now() - datetime.timedelta(seconds=parse_duration(value))
+    except ValueError:
+        raise click.BadParameter('expected a date such as 2021-06-01 or a time ago such as 7d.')
+
+
+def validate_columns(ctx, param, value):
+    if value is None:
+        return None
+
+    return [column.strip() for column in value.split(',') if column.strip()]
+
+
+def echo_lines(lines, chunk=1000):
+    """Writes the lines as they come, a chunk at a time."""
+    import itertools
+    lines = iter(lines)
+    while True:
+        block = list(itertools.islice(lines, chunk))
+        if not block:
+            break
+        click.echo('\n'.join(block))
+
+
+def page_options(command):
+    """Options shared by the commands listing the queues."""
+    options = [
+        click.option('--limit', type=click.IntRange(min=0), default=None,
+                        help='shows at most this many rows'),
+        click.option('--offset', type=click.IntRange(min=0), default=0,
+                        help='skips this many rows first'),
+        click.option('--since', callback=validate_since, default=None,
+                        help='shows only rows added since a date or a time ago, e.g. 2021-06-01 or 7d'),
+        click.option('--columns', callback=validate_columns, default=None,
+                        help='shows only these columns, e.g. id,status,command'),
+        click.option('--format', 'format', type=click.Choice(['table', 'json', 'csv', 'ndjson']),
+                        default='table', help='output format'),
+    ]
+    for option in reversed(options):
+        command = option(command)
+
+    return command
+
+
+def validate_ids(ctx, param, value):
+    if value is None:
+        return []
+
+    try:
+        return [int(task_id) for task_id in value.split(',') if task_id.strip()]
+    except ValueError:
+        raise click.BadParameter('expected task IDs separated by commas, e.g. 123,124.')
+
+
 @click.group()
 @click.version_option(version='1.1.3')
 def main():
@@ -36,18 +134,94 @@ def install(home_path, owner_id):
 @main.command(short_help='adds a new task to queue')
 @click.argument('command',
                 type=str,
-                required=True)
+                required=False)
 @click.argument('context',
                 type=click.Path(exists=True),
                 required=False)
-def add(command, context):
+@click.option('--cpus', type=click.IntRange(min=1), default=1,
+                help='number of CPU cores used by the task')
+@click.option('--mem', callback=validate_size, default=None,
+                help='memory used by the task, e.g. 512M or 32G')
+@click.option('--walltime', callback=validate_duration, default=None,
+                help='estimated run time, e.g. 30m or 2h')
+@click.option('--from-file', 'from_file', type=click.File('r'), default=None,
+                help='adds one task per line of the file, use - for stdin')
+@click.option('--array', callback=validate_array, default=None,
+                help='adds a job array, {i} in the command is replaced by each index, e.g. 0-99')
+@click.option('--after', callback=validate_ids, default=None,
+                help='starts only after these tasks finish, e.g. 123,124')
+@click.option('--after-ok', 'after_ok', callback=validate_ids, default=None,
+                help='starts only after these tasks complete, canceled otherwise')
+@click.option('--retries', type=click.IntRange(min=0), default=0,
+                help='times the task is started again when it fails')
+@click.option('--retry-backoff', 'retry_backoff', callback=validate_duration, default=None,
+                help='wait before the first retry, doubled after each one, e.g. 30s or 5m')
+@click.option('--priority', type=int, default=0,
+                help='tasks with a higher priority start first')
+@click.option('--preemptible', is_flag=True,
+                help='lets the task be stopped and queued again for tasks of higher priority')
+def add(command, context, cpus, mem, walltime, from_file, array, after, after_ok, retries,
+        retry_backoff, priority, preemptible):
+    if (command is None) == (from_file is None):
+        click.echo('Please give either a command or --from-file.')
+        return None
+    if from_file is not None and array is not None:
+        click.echo('Job arrays can not be added from a file.')
+        return None
+
+    from taskq.utils import Configuration, get_capacity, request_dispatcher
+    capacity = get_capacity()
+    if cpus > capacity['cpus'] or (mem or 0) > capacity['mem']:
+        click.echo('Impossible to add task.')
+        click.echo('The machine has {} CPUs and {} bytes of memory.'.format(capacity['cpus'], capacity['mem']))
+        return None
+
+    commands = None
+    if from_file is not None:
+        commands = [line.strip() for line in from_file]
+        commands = [cmd for cmd in commands if cmd and not cmd.startswith('#')]
+
+    # The running Task Handler adds the task for us, which spares loading the
+    # database layer on every call. Without it, the task is added here.
+    config = Configuration()
+    ENV = config.loadEnv()
+    options = {
+        'cpus': cpus, 'mem': mem, 'walltime': walltime, 'array': array,
+        'after': after, 'after_ok': after_ok, 'retries': retries,
+        'retry_backoff': retry_backoff, 'priority': priority, 'preemptible': preemptible,
+    }
+    reply = request_dispatcher(ENV, {'op': 'submit', 'command': command, 'context': context,
+                                     'commands': commands, 'options': options})
+    if reply is None:
+        reply = add_to_db(command, context, commands, options)
+
+    if 'error' in reply:
+        click.echo('Impossible to add task.')
+        click.echo(reply['error'])
+        return None
+
+    if commands is not None:
+        task_ids = reply['task_ids']
+        if task_ids:
+            click.echo('Tasks with ID={} to ID={} added to the queue!'.format(*task_ids))
+        return task_ids
+
+    return reply['task_id']
+
+
+def add_to_db(command, context, commands, options):
     from taskq.resources import TaskCreator
     user_id = os.getuid()
     user_name = pwd.getpwuid( os.getuid() ).pw_name
 
-    task = TaskCreator(command, context, user_id, user_name)
-    task_id = task.add_to_queue()
-    return task_id
+    task = TaskCreator(command, context, user_id, user_name, **options)
+    if task.get_pending() is None:
+        return {'error': 'Its dependencies do not exist or can not complete anymore.'}
+
+    if commands is not None:
+        return {'task_ids': task.add_many(commands)}
+
+    return {'task_id': task.add_to_queue()}
 
 
 
@@ -58,18 +232,21 @@ def add(command, context):
                 type=int,
                 required=True)
 def abort(task_id):
-    from taskq.resources import TaskQHelper
-    ownership = TaskQHelper.check_ownership(task_id, os.getuid())
+    from taskq.utils import Configuration, request_dispatcher
+    config = Configuration()
+    ENV = config.loadEnv()
 
-    if ownership is True:
-        response = TaskQHelper.abort_task(task_id)
-        if response:
-            click.echo('Task with ID={} successfully added to abort queue!'.format(task_id))
-        else:
-            click.echo('Task with ID={} is not running anymore, impossible to abort!'.format(task_id))
-    else:
+    # The Task Handler knows who is asking from the socket itself.
+    reply = request_dispatcher(ENV, {'op': 'cancel', 'task_id': task_id})
+    if reply is None:
+        from taskq.resources import TaskQHelper
+        reply = TaskQHelper.cancel_task(task_id, os.getuid())
+
+    if 'error' in reply:
         click.echo('Impossible to abort task.')
-        click.echo('Only the task owner or the queue owner can abort the task with ID={}.'.format(task_id))
+        click.echo(reply['error'])
+    else:
+        click.echo('Task with ID={} successfully added to abort queue!'.format(task_id))
 
 
 # @main.command(short_help="inserts task back into the queue")
@@ -103,6 +280,101 @@ def info(task_id):
     click.echo(table)
 
 
+@main.command(short_help="shows the resource usage of finished tasks")
+@click.option('--by-user', is_flag=True,
+                help='shows the usage of each user')
+def stats(by_user):
+    from taskq.resources import TaskQHelper
+    table = TaskQHelper.show_stats(by_user)
+
+    click.echo(table)
+
+
+@main.command(short_help="shows the CPU and memory use of the running tasks")
+def top():
+    from taskq.utils import Configuration, request_dispatcher
+    from taskq.resources import TaskQHelper
+    config = Configuration()
+    ENV = config.loadEnv()
+
+    reply = request_dispatcher(ENV, {'op': 'top'})
+    if reply is None:
+        click.echo('The Task Handler is not running.')
+        return
+    if 'error' in reply:
+        click.echo(reply['error'])
+        return
+
+    click.echo(TaskQHelper.show_top(reply['tasks']))
+
+
+@main.command(short_help="shows the output of a task")
+@click.argument('task_id',
+                type=int,
+                required=True)
+@click.option('-n', '--lines', type=int, default=10,
+                help='number of lines to show')
+@click.option('-f', '--follow', is_flag=True,
+                help='keeps showing the output while the task runs')
+def logs(task_id, lines, follow):
+    from taskq.logs import tail, follow as follow_log
+    from taskq.resources import TaskQHelper
+    task = TaskQHelper.get_task(task_id)
+
+    if task is None or task.output is None or not os.path.exists(task.output):
+        click.echo('There is no output for task with ID={}.'.format(task_id))
+        return
+
+    click.echo(tail(task.output, lines), nl=False)
+    if follow:
+        is_running = lambda: TaskQHelper.get_task(task_id).status in ('running', 'canceling')
+        for data in follow_log(task.output, is_running):
+            click.echo(data, nl=False)
+
+
+@main.command(short_help="waits for tasks to finish")
+@click.argument('task_ids',
+                type=int,
+                nargs=-1,
+                required=True)
+@click.option('--all', 'mode', flag_value='all', default=True,
+                help='waits for all the tasks to finish (default)')
+@click.option('--any', 'mode', flag_value='any',
+                help='waits for the first task to finish')
+@click.option('--timeout', callback=validate_duration, default=None,
+                help='gives up after this time, e.g. 90 or 30m')
+def wait(task_ids, mode, timeout):
+    """Exits with 0 when the tasks complete, 1 when one of them ended
+    otherwise and 2 on timeout or error."""
+    from taskq.client import Client, TaskQError
+    try:
+        finished = Client().wait(task_ids, any=mode == 'any', timeout=timeout)
+    except TaskQError as error:
+        click.echo(error)
+        sys.exit(2)
+
+    for task_id, status in sorted(finished.items()):
+        click.echo('Task with ID={} ended as {}.'.format(task_id, status))
+    sys.exit(0 if set(finished.values()) == {'complete'} else 1)
+
+
+@main.command(short_help="streams the status changes of tasks as JSON lines")
+@click.argument('task_ids',
+                type=int,
+                nargs=-1)
+def events(task_ids):
+    import json
+    from taskq.client import Client, TaskQError
+    try:
+        for event in Client().subscribe(list(task_ids) or None):
+            click.echo(json.dumps(event))
+    except TaskQError as error:
+        click.echo(error)
+        sys.exit(2)
+    except KeyboardInterrupt:
+        pass
+
+
 @main.command(short_help='shows queue information')
 @click.option('--all', 'mode', flag_value='all',
                 help='shows all tasks')
@@ -112,11 +384,37 @@ def info(task_id):
                 help='shows only completed tasks')
 @click.option('--mine', 'mode', flag_value='mine',
                 help='show only tasks belonging to the user')
-def show_queue(mode):
-    from taskq.resources import TaskQHelper
-    table = TaskQHelper.show_queue(mode)
+@click.option('--failed', 'mode', flag_value='failed',
+                help='shows only failed, lost or exited tasks')
+@click.option('--blocked', 'mode', flag_value='blocked',
+                help='shows only tasks waiting for their dependencies')
+@click.option('--arrays', 'mode', flag_value='arrays',
+                help='shows the progress of the job arrays')
+@page_options
+def show_queue(mode, limit, offset, since, columns, format):
+    from taskq.utils import Configuration, request_dispatcher
+    config = Configuration()
+    ENV = config.loadEnv()
 
-    click.echo(table)
+    # The live views are rendered by the Task Handler while they are small.
+    # Larger ones, the history and the machine formats are streamed here from
+    # the database.
+    if format == 'table' and mode in (None, 'running', 'blocked', 'arrays'):
+        reply = request_dispatcher(ENV, {'op': 'show_queue', 'mode': mode, 'limit': limit,
+                                         'offset': offset,
+                                         'since': since.isoformat() if since else None,
+                                         'columns': columns})
+        if reply is not None and not reply.get('stream'):
+            click.echo(reply.get('table', reply.get('error')))
+            return
+
+    from taskq.resources import TaskQHelper
+    try:
+        lines = TaskQHelper.show_queue(mode, os.getuid(), limit, offset, since, columns, format)
+    except ValueError as error:
+        click.echo(str(error).capitalize())
+        return
+    echo_lines(lines)
 
 
 @main.command(short_help='shows abort queue information')
@@ -126,11 +424,15 @@ def show_queue(mode):
                 help='shows only completed abort task issues')
 @click.option('--mine', 'mode', flag_value='mine',
                 help='show only abort task issues belonging to the user')
-def show_abort_queue(mode):
+@page_options
+def show_abort_queue(mode, limit, offset, since, columns, format):
     from taskq.resources import TaskQHelper
-    table = TaskQHelper.show_abort_queue(mode)
-
-    click.echo(table)
+    try:
+        lines = TaskQHelper.show_abort_queue(mode, limit, offset, since, columns, format)
+    except ValueError as error:
+        click.echo(str(error).capitalize())
+        return
+    echo_lines(lines)
 
 
 @main.command(short_help='calls the task handler')
@@ -141,23 +443,56 @@ def call_task_handler():
 
     if str(ENV['owner_id']) == str(os.getuid()):
         from taskq.resources import TaskHandler
-        handler = TaskHandler()
+        handler = TaskHandler(capture=False)
         message = handler.handle()
+        handler.reap(block=True)
     else:
         click.echo('Sorry, only the TaskQ Owner can call the TaskQ Bot.')
 
-@main.command(short_help='calls thet task abort handler')
-def call_abort_handler():
+@main.command(short_help='upgrades the queue database schema')
+def migrate():
     from taskq.utils import Configuration
     config = Configuration()
     ENV = config.loadEnv()
 
     if str(ENV['owner_id']) == str(os.getuid()):
-        from taskq.resources import AbortHandler
-        handler = AbortHandler()
-        message = handler.handle()
+        from taskq.models import migrate_db
+        changes = migrate_db()
+        click.echo('Database migrated, {} change(s) applied.'.format(changes))
+    else:
+        click.echo('Sorry, only the TaskQ Owner can migrate the database.')
+
+
+@main.command(short_help='moves old finished tasks to the archive')
+@click.option('--older-than', 'older_than', callback=validate_duration, default=None,
+                help='archives the tasks finished before this time ago, e.g. 30d')
+def archive(older_than):
+    from taskq.utils import Configuration
+    config = Configuration()
+    ENV = config.loadEnv()
+
+    if str(ENV['owner_id']) == str(os.getuid()):
+        from taskq.archive import Archiver
+        from taskq.settings import TASKQ_ARCHIVE_AFTER
+        if older_than is None:
+            older_than = TASKQ_ARCHIVE_AFTER
+        if older_than is None:
+            click.echo('Please give --older-than, the archival is disabled in the settings.')
+            return
+
+        archiver = Archiver()
+        archived = 0
+        while True:
+            count = archiver.archive(older_than)
+            if not count:
+                break
+            archived += count
+        if archived:
+            while archiver.vacuum(full=True):
+                pass
+        click.echo('{} finished tasks and aborts archived.'.format(archived))
     else:
-        click.echo('Sorry, only the TaskQ Owner can call the Abort Handler.')
+        click.echo('Sorry, only the TaskQ Owner can archive the queue.')
 
 
 def initdb():
@@ -168,7 +503,8 @@ def initdb():
     if os.path.exists(ENV['db_path']):
         os.remove(ENV['db_path'])
 
-    from taskq.models import Queue, Variable, AbortQueue
+    from taskq.models import (Queue, Variable, AbortQueue, Usage, TaskArray, Dependency, Lease,
+                              ArchiveIndex)
 
     Queue.create_table()
     click.echo("Table 'Queue' created successfully!")
@@ -176,13 +512,26 @@ def initdb():
     click.echo("Table 'Variable' created successfully!")
     AbortQueue.create_table()
     click.echo("Table 'AbortQueue' created successfully!")
+    Usage.create_table()
+    click.echo("Table 'Usage' created successfully!")
+    TaskArray.create_table()
+    click.echo("Table 'TaskArray' created successfully!")
+    Dependency.create_table()
+    click.echo("Table 'Dependency' created successfully!")
+    Lease.create_table()
+    click.echo("Table 'Lease' created successfully!")
+    ArchiveIndex.create_table()
+    click.echo("Table 'ArchiveIndex' created successfully!")
 
 def fix_db_permissions(db_path):
+    from subprocess import Popen
     with Popen(['sudo chmod g+w {}'.format(db_path)], shell=True, stdin=None, stdout=None, stderr=None, close_fds=True) as proc:
         proc.wait()
 
 @main.command(short_help="starts the queue processing")
-def start():
+@click.option('--standby', is_flag=True,
+                help='starts a Task Handler that takes over when the running one dies')
+def start(standby):
     from taskq.utils import Configuration
     config = Configuration()
     ENV = config.loadEnv()
@@ -190,30 +539,33 @@ def start():
     if str(ENV['owner_id']) == str(os.getuid()):
         import taskq
         from taskq.resources import TaskQHelper
-        from taskq.utils import start_script
+        from taskq.utils import start_script, request_dispatcher
 
         TASK_HANDLER_ACTIVE = TaskQHelper.get_variable('TASK_HANDLER_ACTIVE')
-        ABORT_HANDLER_ACTIVE = TaskQHelper.get_variable('ABORT_HANDLER_ACTIVE')
         TASKQ_STARTED = TaskQHelper.get_variable('TASKQ_STARTED')
-        if TASKQ_STARTED is None:
+        if standby:
+            if TASKQ_STARTED is None or TASKQ_STARTED.value == 'False':
+                click.echo('Impossible to start a standby, TaskQ Queue not active.')
+            else:
+                click.echo('Starting standby Task Handler...')
+                start_script('task-handler.py', '--standby')
+        elif TASKQ_STARTED is None:
             click.echo('Starting Task Handler...')
             start_script('task-handler.py')
-            click.echo('Starting Abort Handler...')
-            start_script('abort-handler.py')
             TASKQ_STARTED = TaskQHelper.modify_variable('TASKQ_STARTED','True')
         else:
             if TASKQ_STARTED.value == 'False':
                 click.echo('Restarting Task Handler...')
                 start_script('task-handler.py')
-                click.echo('Restarting Abort Handler...')
-                start_script('abort-handler.py')
                 TASKQ_STARTED = TaskQHelper.modify_variable('TASKQ_STARTED','True')
+            elif request_dispatcher(ENV, {'op': 'ping'}) is None:
+                # The Task Handler died without being stopped.
+                click.echo('Task Handler is not responding, restarting it...')
+                start_script('task-handler.py')
             else:
                 TASK_HANDLER_PID = TaskQHelper.get_variable('TASK_HANDLER_PID')
-                ABORT_HANDLER_PID = TaskQHelper.get_variable('ABORT_HANDLER_PID')
                 click.echo('TaskQ queue ready!')
                 click.echo('Task Handler PID: {}'.format(TASK_HANDLER_PID.value))
-                click.echo('Abort Handler PID: {}'.format(ABORT_HANDLER_PID.value))
 
     else:
         click.echo('Sorry, only the TaskQ Owner can start the queue.')
@@ -227,25 +579,24 @@ def stop():
 
     if str(ENV['owner_id']) == str(os.getuid()):
         from taskq.resources import TaskQHelper
+        from taskq.utils import request_dispatcher
 
         TASKQ_STARTED = TaskQHelper.get_variable('TASKQ_STARTED')
         if TASKQ_STARTED is not None:
 
             if TASKQ_STARTED.value == 'True':
                 TASK_HANDLER_PID = TaskQHelper.get_variable('TASK_HANDLER_PID')
-                ABORT_HANDLER_PID = TaskQHelper.get_variable('ABORT_HANDLER_PID')
-
-                if TASK_HANDLER_PID is not None and ABORT_HANDLER_PID is not None:
-                    cmd = 'kill -9 {}'.format(str(TASK_HANDLER_PID.value))
-                    proc = Popen(cmd, shell=True, stdin=None, stdout=None, stderr=None, close_fds=True)
-                    proc.wait()
-                    cmd = 'kill -9 {}'.format(str(ABORT_HANDLER_PID.value))
-                    proc = Popen(cmd, shell=True, stdin=None, stdout=None, stderr=None, close_fds=True)
-                    proc.wait()
+
+                if TASK_HANDLER_PID is not None:
+                    # Standby Task Handlers see the queue stopped and leave too.
                     TASKQ_STARTED = TaskQHelper.modify_variable('TASKQ_STARTED','False')
+                    if request_dispatcher(ENV, {'op': 'stop'}) is None:
+                        try:
+                            os.kill(int(TASK_HANDLER_PID.value), signal.SIGTERM)
+                        except ProcessLookupError:
+                            pass
                     click.echo("TaskQ Queue successfully stoped!")
                     TaskQHelper.del_variable('TASK_HANDLER_PID')
-                    TaskQHelper.del_variable('ABORT_HANDLER_PID')
 
                 else:
                     click.echo('Impossible to find TaskQ Bot PID!')
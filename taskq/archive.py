@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+import os
+import gzip
+import json
+import peewee
+import datetime
+from taskq.models import db, Queue, AbortQueue, TaskArray, Dependency, ArchiveIndex, ACTIVE, ENV
+from taskq.settings import TASKQ_ARCHIVE_CHUNK
+
+# Rows deleted by each statement, below the SQLite limit of variables.
+DELETE_CHUNK = 500
+# Free pages given back to the file system per call to vacuum.
+VACUUM_CHUNK = 1000
+
+
+def get_archive_path(env):
+    return os.path.join(env['taskq_home_path'], 'archive')
+
+
+class Archiver:
+    """Moves finished tasks and aborts out of the database to monthly files of
+    JSON lines, queue-YYYY-MM.ndjson.gz and abort-YYYY-MM.ndjson.gz, by the
+    month the rows were created. Each batch is appended to the file as a new
+    gzip member and its range of IDs is recorded in ArchiveIndex."""
+
+    def __init__(self, path=None):
+        self.path = path or get_archive_path(ENV)
+
+    def archive(self, older_than, limit=TASKQ_ARCHIVE_CHUNK):
+        """Archives up to limit tasks and limit aborts that finished more
+        than older_than seconds ago, returning how many rows were moved."""
+        cutoff = datetime.datetime.now() - datetime.timedelta(seconds=older_than)
+        end = peewee.fn.COALESCE(Queue.completed_at, Queue.canceled_at, Queue.created_at)
+        # Arrays are kept while one of their elements may still update them.
+        active_arrays = (Queue.select(Queue.parent_id)
+                              .where(Queue.status.in_(ACTIVE) & Queue.parent_id.is_null(False))
+                          )
+        tasks = list(Queue.select()
+                          .where(Queue.status.not_in(ACTIVE)
+                                 & (end < cutoff)
+                                 & Queue.id.not_in(active_arrays))
+                          .order_by(Queue.id.asc())
+                          .limit(limit)
+                          .dicts()
+                      )
+        arrays = {array['task_id']: array for array in
+                    TaskArray.select()
+                             .where(TaskArray.task_id.in_([task['id'] for task in tasks
+                                                           if task['array_size']]))
+                             .dicts()}
+        for task in tasks:
+            if task['id'] in arrays:
+                task['array'] = arrays[task['id']]
+        self.move('queue', tasks, self.delete_tasks)
+
+        aborts = list(AbortQueue.select()
+                                .where((AbortQueue.is_complete == True)
+                                       & (AbortQueue.completed_at < cutoff))
+                                .order_by(AbortQueue.id.asc())
+                                .limit(limit)
+                                .dicts()
+                      )
+        self.move('abort', aborts, self.delete_aborts)
+
+        return len(tasks) + len(aborts)
+
+    def move(self, kind, rows, delete):
+        months = {}
+        for row in rows:
+            months.setdefault(row['created_at'].strftime('%Y-%m'), []).append(row)
+
+        os.makedirs(self.path, exist_ok=True)
+        for month, rows in sorted(months.items()):
+            name = '{}-{}.ndjson.gz'.format(kind, month)
+            # The rows are on disk before they leave the database. Should we
+            # stop in between, they are archived again, and finding either
+            # copy is as good.
+            with open(os.path.join(self.path, name), 'ab') as file:
+                with gzip.GzipFile(fileobj=file, mode='wb') as archive:
+                    for row in rows:
+                        archive.write(json.dumps(row, default=str).encode() + b'\n')
+                file.flush()
+                os.fsync(file.fileno())
+
+            ids = [row['id'] for row in rows]
+            with db.atomic():
+                ArchiveIndex.insert(kind=kind, path=name, first_id=min(ids), last_id=max(ids),
+                                    rows=len(ids)).execute()
+                for chunk in peewee.chunked(ids, DELETE_CHUNK):
+                    delete(chunk)
+
+    def delete_tasks(self, ids):
+        Queue.delete().where(Queue.id.in_(ids)).execute()
+        TaskArray.delete().where(TaskArray.task_id.in_(ids)).execute()
+        # The edges of a finished task have been followed already.
+        (Dependency.delete()
+                   .where(Dependency.task_id.in_(ids) | Dependency.depends_on.in_(ids))
+                   .execute()
+          )
+
+    def delete_aborts(self, ids):
+        AbortQueue.delete().where(AbortQueue.id.in_(ids)).execute()
+
+    def vacuum(self, pages=VACUUM_CHUNK, full=False):
+        """Gives up to pages of the pages freed by the archival back to the
+        file system, returning how many are still free. A database without
+        incremental auto_vacuum can only be rebuilt in full, which holds it
+        meanwhile, so that is only done with full=True and once a quarter of
+        it is free. The rebuild also turns incremental auto_vacuum on when the
+        database profile sets it."""
+        if db.execute_sql('PRAGMA auto_vacuum').fetchone()[0] == 2:
+            # Run as a statement, sqlite3 steps it once and only one page is
+            # freed.
+            db.connection().executescript('PRAGMA incremental_vacuum({});'.format(pages))
+            return db.execute_sql('PRAGMA freelist_count').fetchone()[0]
+
+        free = db.execute_sql('PRAGMA freelist_count').fetchone()[0]
+        if full and free * 4 > db.execute_sql('PRAGMA page_count').fetchone()[0]:
+            db.execute_sql('VACUUM')
+        return 0
+
+    def find(self, kind, row_id):
+        """The archived row of a task, or of an abort with kind 'abort', None
+        when it is not in the archive."""
+        batches = (ArchiveIndex.select()
+                               .where((ArchiveIndex.kind == kind)
+                                      & (ArchiveIndex.first_id <= row_id)
+                                      & (ArchiveIndex.last_id >= row_id))
+                               .order_by(ArchiveIndex.id.desc())
+                   )
+        # The rows start with their ID, so the others are not parsed.
+        prefix = '{{"id": {},'.format(row_id).encode()
+        for path in dict.fromkeys(batch.path for batch in batches):
+            try:
+                with gzip.open(os.path.join(self.path, path), 'rb') as archive:
+                    for line in archive:
+                        if line.startswith(prefix):
+                            return json.loads(line)
+            except FileNotFoundError:
+                continue
+
+        return None
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+import os
+import json
+import time
+import socket
+from taskq.models import ACTIVE
+from taskq.settings import TASKQ_LEASE_TTL
+from taskq.utils import Configuration, get_socket_path
+
+
+class TaskQError(Exception):
+    pass
+
+
+class Client:
+    """Talks to the running Task Handler through its control socket. The
+    Task Handler identifies the user from the socket itself, so every call is
+    done on behalf of the user running this process.
+
+        client = Client()
+        task_id = client.submit('python3 train.py', cpus=4, mem=8 * 1024**3)
+        for event in client.subscribe([task_id]):
+            print(event['status'])
+    """
+
+    def __init__(self, socket_path=None, timeout=30):
+        if socket_path is None:
+            env = Configuration().loadEnv()
+            if env is None:
+                raise TaskQError('TaskQ is not installed.')
+            socket_path = get_socket_path(env)
+        self.socket_path = socket_path
+        self.timeout = timeout
+
+    def connect(self, message):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.socket_path)
+        except OSError:
+            sock.close()
+            raise TaskQError('The Task Handler is not running.')
+
+        sock.sendall(json.dumps(message).encode() + b'\n')
+        return sock
+
+    def request(self, message):
+        """Sends a message and returns the reply, raising TaskQError when it
+        is an error."""
+        with self.connect(message) as sock:
+            try:
+                line = sock.makefile('rb').readline()
+            except OSError:
+                line = None
+
+        if not line:
+            raise TaskQError('The Task Handler did not answer.')
+
+        reply = json.loads(line)
+        if 'error' in reply:
+            raise TaskQError(reply['error'])
+
+        return reply
+
+    def submit(self, command, context=None, **options):
+        """Adds a task, returning its ID. The options are the ones of
+        taskq add, with sizes in bytes and durations in seconds."""
+        if context is None:
+            context = os.getcwd()
+
+        return self.request({'op': 'submit', 'command': command, 'context': context,
+                             'options': options})['task_id']
+
+    def submit_many(self, commands, context=None, **options):
+        """Adds a task per command, returning the first and last task IDs."""
+        if context is None:
+            context = os.getcwd()
+
+        return self.request({'op': 'submit', 'command': None, 'context': context,
+                             'commands': list(commands), 'options': options})['task_ids']
+
+    def cancel(self, task_id):
+        self.request({'op': 'cancel', 'task_id': task_id})
+
+    def list(self, status=None, user_id=None, limit=None, after=None):
+        """The tasks with one of the statuses, the active ones by default, of
+        one user if user_id is given, as dicts. The Task Handler returns a page
+        of up to limit tasks, 1000 at most, with an ID above after."""
+        return self.request({'op': 'list', 'status': status, 'user_id': user_id,
+                             'limit': limit, 'after': after})['tasks']
+
+    def list_all(self, status=None, user_id=None):
+        """Yields every task of list, a page at a time."""
+        after = None
+        while True:
+            reply = self.request({'op': 'list', 'status': status, 'user_id': user_id,
+                                  'after': after})
+            yield from reply['tasks']
+            after = reply['next']
+            if after is None:
+                return
+
+    def info(self, task_id):
+        return self.request({'op': 'info', 'task_id': task_id})['task']
+
+    def subscribe(self, task_ids=None):
+        """Yields the status changes of the tasks, or of every task, as they
+        happen. The connection is closed when the generator is, and
+        TaskQError is raised when the Task Handler closes it."""
+        with self.connect({'op': 'subscribe', 'task_ids': task_ids}) as sock:
+            sock.settimeout(None)
+            lines = sock.makefile('rb')
+            line = lines.readline()
+            if not line:
+                raise TaskQError('The Task Handler did not answer.')
+            reply = json.loads(line)
+            if 'error' in reply:
+                raise TaskQError(reply['error'])
+
+            for line in lines:
+                yield json.loads(line)
+
+        raise TaskQError('The Task Handler closed the connection.')
+
+    def wait(self, task_ids, any=False, timeout=None):
+        """Blocks until all the tasks, or the first of them with any=True,
+        finished, returning their {task id: status}. Raises TaskQError after
+        timeout seconds. The Task Handler pushes the status changes, so
+        nothing is polled meanwhile."""
+        # Each task is counted once, however often it is given.
+        task_ids = list(dict.fromkeys(int(task_id) for task_id in task_ids))
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        is_done = lambda: finished and (any or len(finished) == len(task_ids))
+        lost_at = None
+
+        while True:
+            if deadline is not None and time.monotonic() >= deadline:
+                raise TaskQError('Timed out waiting for the tasks.')
+            try:
+                sock = self.connect({'op': 'subscribe', 'task_ids': task_ids})
+            except TaskQError:
+                # A standby Task Handler may be taking over.
+                if lost_at is None or time.monotonic() - lost_at > 2 * TASKQ_LEASE_TTL:
+                    raise
+                time.sleep(1)
+                continue
+
+            with sock:
+                lines = sock.makefile('rb')
+                reply = self.read(sock, lines, deadline)
+                if reply is not None:
+                    lost_at = None
+                    missing = set(task_ids) - {int(task_id) for task_id in reply['statuses']}
+                    if missing:
+                        raise TaskQError('There is no task with ID={}.'.format(min(missing)))
+
+                    finished = {int(task_id): status
+                                for task_id, status in reply['statuses'].items()
+                                if status not in ACTIVE}
+                    while not is_done():
+                        event = self.read(sock, lines, deadline)
+                        if event is None:
+                            break
+                        if event['status'] not in ACTIVE:
+                            finished[event['task_id']] = event['status']
+                        else:
+                            finished.pop(event['task_id'], None)
+                    else:
+                        return finished
+
+            if lost_at is None:
+                lost_at = time.monotonic()
+
+    def read(self, sock, lines, deadline):
+        """Reads a message, None when the connection or the deadline ends."""
+        if deadline is not None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            sock.settimeout(remaining)
+        else:
+            sock.settimeout(None)
+
+        try:
+            line = lines.readline()
+        except OSError:
+            return None
+
+        return json.loads(line) if line else None
@@ -0,0 +1,543 @@
+#!/usr/bin/env python3
+import os
+import pwd
+import json
+import time
+import select
+import signal
+import socket
+import struct
+import datetime
+import traceback
+from taskq.models import db, migrate_db
+from taskq.settings import (TASKQ_POLL_INTERVAL, TASKQ_SAMPLE_INTERVAL, TASKQ_HEARTBEAT,
+                            TASKQ_LEASE_TTL, TASKQ_ARCHIVE_AFTER, TASKQ_ARCHIVE_INTERVAL)
+from taskq.resources import TaskHandler, AbortHandler, TaskCreator, TaskQHelper, ENV
+from taskq.monitor import Sampler
+from taskq.lease import LeaseKeeper
+from taskq.archive import Archiver
+from taskq.utils import get_socket_path, get_capacity
+
+SUBMIT_OPTIONS = {'cpus', 'mem', 'walltime', 'array', 'after', 'after_ok', 'retries',
+                  'retry_backoff', 'priority', 'preemptible'}
+
+# Seconds a client has to send its request, and to read the reply.
+REQUEST_TIMEOUT = 10
+REPLY_TIMEOUT = 1
+# Tasks in a page of the list op.
+LIST_LIMIT = 1000
+# Rows of show-queue rendered by the Task Handler, larger views are streamed by
+# the client from the database.
+LIVE_ROWS = 1000
+# Bytes of events kept for a subscriber that reads slower than they come,
+# past which it is dropped.
+SUBSCRIBER_BUFFER = 16 * 1024 * 1024
+
+
+class Dispatcher:
+    def __init__(self):
+        self.handler = TaskHandler()
+        self.aborter = AbortHandler()
+        self.sampler = Sampler()
+        self.sample_at = 0
+        self.archiver = Archiver()
+        self.archive_at = 0
+        self.archived = 0
+        self.lease = LeaseKeeper()
+        self.handler.lease = self.lease
+        # Both handlers report the status changes of the tasks to the same
+        # list, which is sent to the subscribers after every pass.
+        self.events = []
+        self.handler.events = self.events
+        self.aborter.events = self.events
+        self.subscribers = {}
+        # Events not sent yet to each subscriber, flushed as select() finds
+        # it writable.
+        self.outgoing = {}
+        # Connections whose request has not fully arrived yet, by socket:
+        # [uid, bytes read, deadline].
+        self.requests = {}
+        self.leading = False
+        self.socket_path = get_socket_path(ENV)
+        self.server = None
+        self.wakeup = None
+        self.active = False
+
+    def run(self, standby=False):
+        db.connect(reuse_if_open=True)
+        migrate_db()
+        signal.signal(signal.SIGTERM, self.signal_term)
+        self.active = True
+        if not self.lead(standby):
+            return
+
+        adopted = self.handler.recover()
+        if adopted:
+            print('Adopted {} tasks left running by the previous Task Handler.'.format(adopted))
+        self.aborter.resume()
+        self.listen()
+        self.wakeup = socket.socketpair()
+        for sock in self.wakeup:
+            sock.setblocking(False)
+        signal.set_wakeup_fd(self.wakeup[1].fileno())
+        TaskQHelper.modify_variable('TASK_HANDLER_PID', str(os.getpid()))
+        TaskQHelper.modify_variable('TASK_HANDLER_ACTIVE', 'True')
+        signal.signal(signal.SIGCHLD, self.signal_chld)
+
+        try:
+            while self.active:
+                if not self.lease.renew():
+                    print('The lease was taken over by another Task Handler, stopping.')
+                    self.leading = False
+                    break
+                self.handler.reap()
+                self.aborter.handle()
+                self.handler.handle()
+                # Processes of aborted tasks are not our children, so their
+                # exit has to be polled.
+                timeout = 0.1 if self.aborter.terminating else TASKQ_POLL_INTERVAL
+                timeout = min(timeout, TASKQ_HEARTBEAT)
+                # Adopted tasks do not raise SIGCHLD either.
+                if self.handler.adopted:
+                    timeout = min(timeout, 1)
+                # So do clients that never finish their request.
+                if self.requests:
+                    timeout = min(timeout, 1)
+                retry = self.handler.get_retry_timeout()
+                if retry is not None:
+                    timeout = min(timeout, retry)
+                if TASKQ_SAMPLE_INTERVAL:
+                    if time.monotonic() >= self.sample_at:
+                        self.sample()
+                    timeout = min(timeout, max(self.sample_at - time.monotonic(), 0))
+                if TASKQ_ARCHIVE_AFTER:
+                    if time.monotonic() >= self.archive_at:
+                        self.archive()
+                    timeout = min(timeout, max(self.archive_at - time.monotonic(), 0))
+                self.publish()
+                self.wait(timeout)
+        finally:
+            self.close()
+
+
+    def lead(self, standby):
+        """Takes the lease, waiting for the current leader to stop renewing
+        it: for good as a standby, or up to TASKQ_LEASE_TTL seconds otherwise,
+        in case a crashed leader still holds it."""
+        deadline = datetime.datetime.now() + datetime.timedelta(seconds=TASKQ_LEASE_TTL + 1)
+        while self.active:
+            if self.lease.acquire():
+                self.leading = True
+                return True
+
+            leader = LeaseKeeper.get_leader()
+            if not standby and datetime.datetime.now() >= deadline:
+                print('Task Handler {} is already running.'.format(leader.holder if leader else ''))
+                return False
+            if standby:
+                # The standby Task Handlers leave with the queue.
+                started = TaskQHelper.get_variable('TASKQ_STARTED')
+                if started is not None and started.value == 'False':
+                    return False
+            time.sleep(TASKQ_HEARTBEAT)
+
+        return False
+
+
+    def sample(self):
+        tasks = {task.id: task.pid for task in self.handler.get_running() if task.pid}
+        self.sampler.sample(tasks)
+        self.sample_at = time.monotonic() + TASKQ_SAMPLE_INTERVAL
+
+
+    def archive(self):
+        """Archives a chunk of the old finished rows per pass, so a long
+        history is moved without holding the loop, then gives the freed pages
+        back the same way."""
+        archived = self.archiver.archive(TASKQ_ARCHIVE_AFTER)
+        self.archived += archived
+        if archived:
+            self.archive_at = time.monotonic()
+            return
+
+        if self.archived:
+            print('Archived {} finished tasks and aborts.'.format(self.archived))
+            self.archived = 0
+        if self.archiver.vacuum():
+            self.archive_at = time.monotonic()
+            return
+        self.archive_at = time.monotonic() + TASKQ_ARCHIVE_INTERVAL
+
+
+    def listen(self):
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(self.socket_path)
+        os.chmod(self.socket_path, 0o770)
+        self.server.listen(64)
+        self.server.setblocking(False)
+
+
+    def wait(self, timeout):
+        fds = [self.server, self.wakeup[0]] + list(self.subscribers) + list(self.requests)
+        pending = [conn for conn, buffer in self.outgoing.items() if buffer]
+        readable, writable, _ = select.select(fds, pending, [], timeout)
+
+        for fd in readable:
+            if fd is self.wakeup[0]:
+                self.drain_wakeup()
+            elif fd is self.server:
+                self.accept()
+            elif fd in self.subscribers:
+                # Subscribers send nothing after their request, so this is
+                # them leaving.
+                self.unsubscribe(fd)
+            elif fd in self.requests:
+                self.read_request(fd)
+
+        for conn in writable:
+            # Unless it left meanwhile.
+            if conn in self.outgoing:
+                self.flush(conn)
+
+        now = time.monotonic()
+        for conn, (_, _, deadline) in list(self.requests.items()):
+            if now >= deadline:
+                del self.requests[conn]
+                conn.close()
+
+
+    def drain_wakeup(self):
+        try:
+            while self.wakeup[0].recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+
+
+    def accept(self):
+        """Takes the new connections without waiting for their request,
+        which is read by select() as it arrives, so a slow or idle client
+        does not hold the loop."""
+        while True:
+            try:
+                conn, _ = self.server.accept()
+            except BlockingIOError:
+                return
+
+            try:
+                # The kernel tells who is connected, so requests are done on
+                # behalf of that user.
+                creds = conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED,
+                                        struct.calcsize('3i'))
+                _, uid, _ = struct.unpack('3i', creds)
+            except OSError:
+                conn.close()
+                continue
+            conn.setblocking(False)
+            self.requests[conn] = [uid, b'', time.monotonic() + REQUEST_TIMEOUT]
+            # Clients send their request right away, it is usually there.
+            self.read_request(conn)
+
+
+    def read_request(self, conn):
+        """Reads what arrived of a request, and handles it once its line is
+        complete."""
+        request = self.requests[conn]
+        try:
+            data = conn.recv(65536)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b''
+
+        request[1] += data
+        if data and b'\n' not in data:
+            return
+
+        del self.requests[conn]
+        uid, line = request[0], request[1].partition(b'\n')[0]
+        # Clients wait for their reply, one that stops reading is dropped
+        # after REPLY_TIMEOUT.
+        conn.settimeout(REPLY_TIMEOUT)
+        try:
+            message = json.loads(line or b'{}')
+            if self.respond(conn, message, uid):
+                return
+        except (OSError, ValueError):
+            pass
+        conn.close()
+
+
+    def respond(self, conn, message, uid):
+        """Sends the reply to a message, returning True when the connection
+        was kept to subscribe. A request that fails is answered with the error
+        instead of stopping the loop."""
+        if not isinstance(message, dict):
+            send(conn, {'error': 'The request must be a JSON object.'})
+            return False
+
+        try:
+            if message.get('op') == 'subscribe':
+                return self.subscribe(conn, message)
+            reply = self.dispatch(message, uid)
+        except Exception as error:
+            print('Failed to handle {!r}:'.format(message.get('op')))
+            traceback.print_exc()
+            reply = {'error': 'The request failed: {}.'.format(error)}
+
+        if reply is not None:
+            send(conn, reply)
+        return False
+
+
+    def dispatch(self, message, uid=None):
+        """Handles a message from the user uid, returning the reply to send
+        back if any."""
+        # Every message wakes the main loop up, which then handles the pending
+        # aborts and tasks. 'abort' messages refer to a row in AbortQueue,
+        # which is kept as the audit log of the aborts.
+        if message.get('op') == 'top':
+            return {'tasks': self.sampler.summary()}
+        if message.get('op') == 'ping':
+            return {'pid': os.getpid()}
+        if message.get('op') == 'stop':
+            if str(uid) != str(ENV['owner_id']):
+                return {'error': 'Only the TaskQ Owner can stop the queue.'}
+            self.active = False
+            return {'pid': os.getpid()}
+        if message.get('op') == 'submit':
+            return self.submit(message, uid)
+        if message.get('op') in ('cancel', 'info') and not is_integer(message.get('task_id')):
+            return {'error': 'The task ID must be an integer.'}
+        if message.get('op') == 'cancel':
+            return self.cancel(message, uid)
+        if message.get('op') == 'list':
+            status = message.get('status')
+            if not is_text(*(status if isinstance(status, list) else [status])):
+                return {'error': 'The status must be a string or a list of strings.'}
+            if message.get('user_id') is not None and not is_integer(message.get('user_id')):
+                return {'error': 'The user ID must be an integer.'}
+            return self.list_tasks(message, status)
+        if message.get('op') == 'info':
+            task = TaskQHelper.get_task_data(message.get('task_id'))
+            if task is None:
+                return {'error': 'There is no task with ID={}.'.format(message.get('task_id'))}
+            return {'task': task}
+        if message.get('op') == 'show_queue':
+            return self.show_queue(message, uid)
+
+        return None
+
+
+    def submit(self, message, uid):
+        """Adds the task, or the tasks of a file, sent by taskq add."""
+        options = message.get('options') or {}
+        if not isinstance(options, dict):
+            return {'error': 'The options must be a JSON object.'}
+        unknown = set(options) - SUBMIT_OPTIONS
+        if unknown:
+            return {'error': 'Unknown options: {}.'.format(', '.join(sorted(unknown)))}
+        error = check_options(options)
+        if error is not None:
+            return {'error': error}
+        if not message.get('command') and message.get('commands') is None:
+            return {'error': 'There is no command to add.'}
+        if not is_text(message.get('command'), message.get('context')):
+            return {'error': 'The command and the context must be strings.'}
+        commands = message.get('commands')
+        if commands is not None and not (isinstance(commands, list) and is_text(*commands)):
+            return {'error': 'The commands must be a list of strings.'}
+
+        capacity = get_capacity()
+        if (options.get('cpus') or 1) > capacity['cpus'] or (options.get('mem') or 0) > capacity['mem']:
+            return {'error': 'The machine has {} CPUs and {} bytes of memory.'.format(
+                        capacity['cpus'], capacity['mem'])}
+
+        task = TaskCreator(message.get('command'), message.get('context'), uid,
+                           get_user_name(uid), **options)
+        if task.get_pending() is None:
+            return {'error': 'Its dependencies do not exist or can not complete anymore.'}
+
+        try:
+            if message.get('commands') is not None:
+                return {'task_ids': task.add_many(message['commands'])}
+            return {'task_id': task.add_to_queue()}
+        except ValueError as error:
+            return {'error': str(error).capitalize()}
+
+
+    def list_tasks(self, message, status):
+        """Replies a page of tasks, with the cursor to pass as after for the
+        next one, so no reply holds the whole history."""
+        limit = message.get('limit')
+        if limit is None:
+            limit = LIST_LIMIT
+        if not is_integer(limit) or not 0 < limit <= LIST_LIMIT:
+            return {'error': 'The limit must be an integer from 1 to {}.'.format(LIST_LIMIT)}
+        after = message.get('after')
+        if after is not None and not is_integer(after):
+            return {'error': 'The cursor must be a task ID.'}
+
+        tasks = TaskQHelper.list_tasks(status, message.get('user_id'), limit, after)
+        return {'tasks': tasks, 'next': tasks[-1]['id'] if len(tasks) == limit else None}
+
+
+    def show_queue(self, message, uid):
+        """Renders the live views of show-queue up to LIVE_ROWS rows. Larger
+        ones, like the history, are read by the client itself so they are
+        streamed without holding the loop."""
+        since = message.get('since')
+        since = datetime.datetime.fromisoformat(since) if since else None
+        limit, offset = message.get('limit'), message.get('offset')
+        try:
+            rows = TaskQHelper.count_queue(message.get('mode'), uid, since) - (offset or 0)
+            if limit is not None:
+                rows = min(rows, limit)
+            if rows > LIVE_ROWS:
+                return {'stream': True}
+
+            lines = TaskQHelper.show_queue(message.get('mode'), uid, limit, offset, since,
+                                           message.get('columns'))
+            return {'table': '\n'.join(lines)}
+        except ValueError as error:
+            return {'error': str(error).capitalize()}
+
+
+    def cancel(self, message, uid):
+        reply = TaskQHelper.cancel_task(message.get('task_id'), uid)
+        # Running tasks are reported by the abort handler once they are gone.
+        self.events.extend(TaskQHelper.get_events(reply.pop('changes', [])))
+
+        return reply
+
+
+    def subscribe(self, conn, message):
+        """Keeps the connection open to send it the events of the tasks in
+        message['task_ids'], or of every task. The reply holds the current
+        status of these tasks, so none of their changes can go unnoticed."""
+        task_ids = message.get('task_ids')
+        if task_ids is not None and not (isinstance(task_ids, list)
+                                         and all(is_integer(task_id) for task_id in task_ids)):
+            send(conn, {'error': 'The task IDs must be a list of integers.'})
+            return False
+
+        statuses = TaskQHelper.get_statuses(task_ids) if task_ids else {}
+        send(conn, {'subscribed': True, 'statuses': statuses})
+        # Events are buffered for a subscriber instead of blocking the loop,
+        # see publish.
+        conn.setblocking(False)
+        self.subscribers[conn] = set(task_ids) if task_ids else None
+        self.outgoing[conn] = bytearray()
+        return True
+
+
+    def unsubscribe(self, conn):
+        del self.subscribers[conn]
+        del self.outgoing[conn]
+        conn.close()
+
+
+    def publish(self):
+        events, self.events[:] = list(self.events), []
+        for event in events:
+            line = json.dumps(event, default=str).encode() + b'\n'
+            for conn, task_ids in self.subscribers.items():
+                if task_ids is None or event['task_id'] in task_ids:
+                    self.outgoing[conn] += line
+
+        for conn, buffer in list(self.outgoing.items()):
+            if buffer:
+                self.flush(conn)
+
+
+    def flush(self, conn):
+        """Sends what the socket of a subscriber takes of its events, the
+        rest waits for select(). A subscriber that falls SUBSCRIBER_BUFFER
+        bytes behind is dropped."""
+        buffer = self.outgoing[conn]
+        try:
+            del buffer[:conn.send(buffer)]
+        except BlockingIOError:
+            pass
+        except OSError:
+            self.unsubscribe(conn)
+            return
+
+        if len(buffer) > SUBSCRIBER_BUFFER:
+            print('Dropped a subscriber {} bytes of events behind.'.format(len(buffer)))
+            self.unsubscribe(conn)
+
+
+    def signal_term(self, signum, frame):
+        self.active = False
+
+
+    def signal_chld(self, signum, frame):
+        # Only used to wake select() up through the wakeup fd, the children
+        # are reaped by the main loop.
+        pass
+
+
+    def close(self):
+        signal.set_wakeup_fd(-1)
+        for conn in list(self.subscribers):
+            self.unsubscribe(conn)
+        for conn in self.requests:
+            conn.close()
+        self.requests.clear()
+        if self.server is not None:
+            self.server.close()
+            self.server = None
+        # After a takeover, the socket and the variables belong to the new
+        # leader.
+        if not self.leading:
+            return
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        TaskQHelper.modify_variable('TASK_HANDLER_ACTIVE', 'False')
+        self.lease.release()
+
+
+def send(conn, message):
+    conn.sendall(json.dumps(message, default=str).encode() + b'\n')
+
+
+def is_integer(value):
+    # JSON booleans are ints to Python.
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def is_text(*values):
+    return all(value is None or isinstance(value, str) for value in values)
+
+
+def check_options(options):
+    """The error in the options sent to submit, None when their types are
+    the ones taskq add sends."""
+    for name, value in options.items():
+        if value is None:
+            continue
+        if name == 'preemptible':
+            valid = isinstance(value, bool)
+        elif name in ('after', 'after_ok'):
+            valid = isinstance(value, list) and all(is_integer(task_id) for task_id in value)
+        elif name == 'array':
+            valid = (isinstance(value, list) and len(value) == 2
+                     and all(is_integer(index) for index in value))
+        else:
+            valid = is_integer(value)
+        if not valid:
+            return 'Invalid value for {}: {}.'.format(name, json.dumps(value))
+
+    return None
+
+
+def get_user_name(uid):
+    try:
+        return pwd.getpwuid(uid).pw_name
+    except KeyError:
+        # Users without a passwd entry, as in containers, go by their ID.
+        return str(uid)
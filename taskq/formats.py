@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+import io
+import csv
+import json
+import itertools
+
+FORMATS = ('table', 'json', 'csv', 'ndjson')
+
+
+def is_number(value):
+    try:
+        float(value)
+    except ValueError:
+        return False
+
+    return True
+
+
+def render(get_rows, header, format='table'):
+    """Yields the lines of the rows in the given format. get_rows returns a
+    new iterator over the rows each time it is called, so they are streamed
+    from the database instead of being loaded at once."""
+    if format == 'table':
+        return render_table(get_rows, header)
+    if format == 'csv':
+        return render_csv(get_rows(), header)
+    if format == 'json':
+        return render_json(get_rows(), header)
+    if format == 'ndjson':
+        return render_ndjson(get_rows(), header)
+
+    raise ValueError('unknown format {}, expected one of {}.'.format(format, ', '.join(FORMATS)))
+
+
+def render_table(get_rows, header):
+    """Renders the rows as tabulate does by default, numbers aligned to the
+    right and on their decimal point. The widths are measured on a first pass
+    over the rows, so only one row is held at a time."""
+    numeric = [True] * len(header)
+    widths = [0] * len(header)
+    integers = [0] * len(header)
+    fractions = [0] * len(header)
+    count = 0
+    for row in get_rows():
+        count += 1
+        for column, value in enumerate(row):
+            value = str(value)
+            widths[column] = max(widths[column], len(value))
+            if numeric[column] and is_number(value):
+                integer, point, fraction = value.partition('.')
+                integers[column] = max(integers[column], len(integer))
+                fractions[column] = max(fractions[column], len(point + fraction))
+            else:
+                numeric[column] = False
+    if count == 0:
+        numeric = [False] * len(header)
+
+    for column, name in enumerate(header):
+        if numeric[column]:
+            widths[column] = integers[column] + fractions[column]
+        widths[column] = max(widths[column], len(name) + 2)
+
+    def line(values):
+        return '  '.join(value.rjust(width) if is_numeric else value.ljust(width)
+                         for value, width, is_numeric in zip(values, widths, numeric)).rstrip()
+
+    yield line(header)
+    yield line(['-' * width for width in widths])
+    # Rows added since the first pass are left out, they were not measured.
+    for row in itertools.islice(get_rows(), count):
+        values = []
+        for column, value in enumerate(row):
+            value = str(value)
+            if numeric[column]:
+                integer, point, fraction = value.partition('.')
+                value = integer.rjust(integers[column]) + (point + fraction).ljust(fractions[column])
+            values.append(value)
+        yield line(values)
+
+
+def render_csv(rows, header):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='')
+    for row in itertools.chain([header], rows):
+        writer.writerow(['' if value is None else value for value in row])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+
+def render_json(rows, header):
+    encode = json.JSONEncoder(default=str).encode
+    yield '['
+    previous = None
+    for row in rows:
+        if previous is not None:
+            yield previous + ','
+        previous = '  ' + encode(dict(zip(header, row)))
+    if previous is not None:
+        yield previous
+    yield ']'
+
+
+def render_ndjson(rows, header):
+    encode = json.JSONEncoder(default=str).encode
+    for row in rows:
+        yield encode(dict(zip(header, row)))
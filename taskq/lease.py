@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+import os
+import socket
+import datetime
+from taskq.models import db, Lease
+from taskq.settings import TASKQ_LEASE_TTL, TASKQ_HEARTBEAT
+
+
+class LeaseKeeper:
+    """Holds the lease that makes a dispatcher the leader. The leader renews it
+    every TASKQ_HEARTBEAT seconds; once it has not been renewed for
+    TASKQ_LEASE_TTL seconds, any other dispatcher may take it over."""
+
+    def __init__(self, name='dispatcher'):
+        self.name = name
+        self.holder = '{}:{}'.format(socket.gethostname(), os.getpid())
+        self.renew_at = None
+
+    def acquire(self):
+        """Takes the lease if it is free, expired or already ours."""
+        now = datetime.datetime.now()
+        expires_at = now + datetime.timedelta(seconds=TASKQ_LEASE_TTL)
+        with db.atomic('IMMEDIATE'):
+            Lease.insert(name=self.name).on_conflict_ignore().execute()
+            acquired = (Lease.update(holder=self.holder, expires_at=expires_at, renewed_at=now)
+                             .where((Lease.name == self.name)
+                                    & ((Lease.holder == self.holder)
+                                       | Lease.holder.is_null()
+                                       | (Lease.expires_at < now)))
+                             .execute()
+                        )
+
+        if acquired:
+            self.renew_at = now + datetime.timedelta(seconds=TASKQ_HEARTBEAT)
+
+        return bool(acquired)
+
+    def renew(self):
+        """Renews the lease when the heartbeat is due, returning False if
+        another dispatcher took it over meanwhile. A lease that expired while
+        we stalled is still ours until someone takes it; claim() checks the
+        expiry before starting a task, see is_held."""
+        if self.renew_at is not None and datetime.datetime.now() < self.renew_at:
+            return True
+
+        now = datetime.datetime.now()
+        renewed = (Lease.update(expires_at=now + datetime.timedelta(seconds=TASKQ_LEASE_TTL),
+                                renewed_at=now)
+                        .where((Lease.name == self.name) & (Lease.holder == self.holder))
+                        .execute()
+                    )
+        if not renewed:
+            self.renew_at = None
+            return False
+
+        self.renew_at = now + datetime.timedelta(seconds=TASKQ_HEARTBEAT)
+        return True
+
+    def is_held(self):
+        """Checks the lease in the database. Called inside the transaction
+        that claims a task, so a dispatcher that lost the lease while stalled
+        can not start it too."""
+        return (Lease.select()
+                     .where((Lease.name == self.name)
+                            & (Lease.holder == self.holder)
+                            & (Lease.expires_at >= datetime.datetime.now()))
+                     .exists()
+                )
+
+    def release(self):
+        (Lease.update(holder=None, expires_at=None)
+              .where((Lease.name == self.name) & (Lease.holder == self.holder))
+              .execute()
+          )
+
+    @classmethod
+    def get_leader(cls, name='dispatcher'):
+        """The lease of the current leader, None if there is none."""
+        return (Lease.select()
+                     .where((Lease.name == name)
+                            & (Lease.expires_at >= datetime.datetime.now()))
+                     .first()
+                )
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+import os
+import resource
+from taskq.settings import TASKQ_LIMITS, TASKQ_CGROUP_ROOT, TASKQ_CPU_RLIMIT
+
+CPU_PERIOD = 100000
+
+
+def get_cgroup_root():
+    """The cgroup v2 directory tasks are created under: TASKQ_CGROUP_ROOT, or
+    the cgroup the dispatcher runs in."""
+    if TASKQ_CGROUP_ROOT:
+        return TASKQ_CGROUP_ROOT
+
+    mount = None
+    with open('/proc/self/mounts') as file:
+        for line in file:
+            fields = line.split()
+            if fields[2] == 'cgroup2':
+                mount = fields[1]
+                break
+
+    if mount is None:
+        return None
+
+    with open('/proc/self/cgroup') as file:
+        for line in file:
+            if line.startswith('0::'):
+                return os.path.join(mount, line[3:].strip().lstrip('/'))
+
+    return None
+
+
+def write(path, value):
+    with open(path, 'w') as file:
+        file.write(value)
+
+
+class CgroupLimits:
+    """Runs every task in its own cgroup under a delegated cgroup v2 subtree,
+    limiting memory.max and cpu.max."""
+
+    def __init__(self, root):
+        self.root = root
+        self.stale = set()
+
+    @classmethod
+    def setup(cls, root):
+        """Enables the memory and cpu controllers for the children of root,
+        returning None when the subtree is not delegated to us."""
+        if root is None or not os.access(os.path.join(root, 'cgroup.subtree_control'), os.W_OK):
+            return None
+
+        try:
+            with open(os.path.join(root, 'cgroup.controllers')) as file:
+                if not {'memory', 'cpu'} <= set(file.read().split()):
+                    return None
+            # Controllers can only be enabled for the children of a cgroup
+            # without processes, so the dispatcher moves to a leaf of its own.
+            with open(os.path.join(root, 'cgroup.procs')) as file:
+                if str(os.getpid()) in file.read().split():
+                    os.makedirs(os.path.join(root, 'dispatcher'), exist_ok=True)
+                    write(os.path.join(root, 'dispatcher', 'cgroup.procs'), str(os.getpid()))
+            write(os.path.join(root, 'cgroup.subtree_control'), '+memory +cpu')
+        except OSError:
+            return None
+
+        return cls(root)
+
+    def get_path(self, task):
+        return os.path.join(self.root, 'task-{}'.format(task.id))
+
+    def prepare(self, task):
+        """Creates the cgroup of a task, returning the function that moves the
+        task into it before it runs."""
+        path = self.get_path(task)
+        os.makedirs(path, exist_ok=True)
+        if task.mem:
+            write(os.path.join(path, 'memory.max'), str(task.mem))
+            try:
+                write(os.path.join(path, 'memory.swap.max'), '0')
+            except OSError:
+                pass
+        if task.cpus:
+            write(os.path.join(path, 'cpu.max'), '{} {}'.format(task.cpus * CPU_PERIOD, CPU_PERIOD))
+
+        procs = os.path.join(path, 'cgroup.procs')
+        return lambda: write(procs, '0')
+
+    def oom_killed(self, task):
+        try:
+            with open(os.path.join(self.get_path(task), 'memory.events')) as file:
+                events = dict(line.split() for line in file)
+        except OSError:
+            return False
+
+        return int(events.get('oom_kill', 0)) > 0
+
+    def release(self, task):
+        """Removes the cgroup of a finished task. Processes left behind keep
+        it busy, so it is retried on the next release."""
+        self.stale.add(self.get_path(task))
+        for path in list(self.stale):
+            try:
+                os.rmdir(path)
+            except FileNotFoundError:
+                pass
+            except OSError:
+                continue
+            self.stale.discard(path)
+
+
+class RlimitLimits:
+    """Limits the address space of a task to its memory and, with
+    TASKQ_CPU_RLIMIT, its CPU time to its walltime times its cpus. The cpus
+    are not limited otherwise and the OOM killer is never involved."""
+
+    def prepare(self, task):
+        limits = []
+        if task.mem:
+            limits.append((resource.RLIMIT_AS, task.mem))
+        if task.walltime and TASKQ_CPU_RLIMIT:
+            limits.append((resource.RLIMIT_CPU, task.walltime * (task.cpus or 1)))
+
+        def preexec():
+            for limit, value in limits:
+                resource.setrlimit(limit, (value, value))
+
+        return preexec if limits else None
+
+    def oom_killed(self, task):
+        return False
+
+    def release(self, task):
+        pass
+
+
+def get_limits():
+    """The limits enforced as set by TASKQ_LIMITS, None when disabled."""
+    if TASKQ_LIMITS in ('auto', 'cgroup'):
+        limits = CgroupLimits.setup(get_cgroup_root())
+        if limits is not None:
+            return limits
+        if TASKQ_LIMITS == 'cgroup':
+            print('No delegated cgroup v2 subtree, task limits are not enforced.')
+            return None
+    if TASKQ_LIMITS in ('auto', 'rlimit'):
+        return RlimitLimits()
+
+    return None
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+import os
+import sys
+import glob
+import gzip
+import time
+import shutil
+import threading
+from taskq.settings import TASKQ_LOG_MAX_SIZE, TASKQ_LOG_BACKUPS, TASKQ_LOG_COMPRESSION
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+def get_log_path(env, task_id):
+    return os.path.join(env['taskq_home_path'], 'logs', '{}.log'.format(task_id))
+
+
+def compress(path):
+    if TASKQ_LOG_COMPRESSION == 'zstd' and zstandard is not None:
+        with open(path, 'rb') as source, open(path + '.zst', 'wb') as target:
+            zstandard.ZstdCompressor().copy_stream(source, target)
+    else:
+        with open(path, 'rb') as source, gzip.open(path + '.gz', 'wb') as target:
+            shutil.copyfileobj(source, target)
+    os.remove(path)
+
+
+class TaskLog:
+    """Output of a task, rotated by size. The rotated files are numbered in
+    the order they were written (<id>.log.1 is the oldest) and compressed in
+    the background."""
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.file = open(path, 'ab')
+        self.size = self.file.tell()
+        self.rotations = max(self.get_backups(), default=0)
+
+    def get_backups(self):
+        """Maps the number of each rotated file to its paths."""
+        backups = {}
+        for path in glob.glob(glob.escape(self.path) + '.*'):
+            number = path[len(self.path) + 1:].split('.')[0]
+            if number.isdigit():
+                backups.setdefault(int(number), []).append(path)
+
+        return backups
+
+    def write(self, data):
+        if self.size and self.size + len(data) > TASKQ_LOG_MAX_SIZE:
+            self.rotate()
+
+        self.file.write(data)
+        self.file.flush()
+        self.size += len(data)
+
+    def rotate(self):
+        self.file.close()
+        self.rotations += 1
+        backup = '{}.{}'.format(self.path, self.rotations)
+        os.rename(self.path, backup)
+        if TASKQ_LOG_COMPRESSION:
+            threading.Thread(target=compress, args=(backup,), daemon=True).start()
+
+        for number, paths in self.get_backups().items():
+            if number <= self.rotations - TASKQ_LOG_BACKUPS:
+                for path in paths:
+                    os.remove(path)
+
+        self.file = open(self.path, 'ab')
+        self.size = 0
+
+    def close(self):
+        self.file.close()
+
+
+def start_writer(path):
+    """Starts the process that writes the output of a task to its log,
+    returning the fd the task writes to and the writer. The writer leads its
+    own session and exits once every process of the task closed the fd, so
+    the task keeps its output when the dispatcher stops."""
+    from subprocess import Popen
+    read, write = os.pipe()
+    try:
+        writer = Popen([sys.executable, '-m', 'taskq.logs', path], stdin=read, close_fds=True,
+                       start_new_session=True)
+    finally:
+        os.close(read)
+
+    return write, writer
+
+
+def write_log(path):
+    log = TaskLog(path)
+    while True:
+        data = os.read(sys.stdin.fileno(), 65536)
+        if not data:
+            break
+        log.write(data)
+    log.close()
+
+    # The rotated files left are compressed before leaving.
+    for thread in threading.enumerate():
+        if thread is not threading.current_thread():
+            thread.join()
+
+
+def tail(path, lines=10, block_size=8192):
+    """Returns the last lines of a file, reading it backwards by blocks."""
+    with open(path, 'rb') as file:
+        file.seek(0, os.SEEK_END)
+        position = file.tell()
+        data = b''
+        while position > 0 and data.count(b'\n') <= lines:
+            size = min(block_size, position)
+            position -= size
+            file.seek(position)
+            data = file.read(size) + data
+
+    return b'\n'.join(data.split(b'\n')[-lines - 1:])
+
+
+def follow(path, is_running, interval=0.5):
+    """Yields what is appended to a log from its current end, reopening it
+    when it is rotated, until is_running() returns False."""
+    file = open(path, 'rb')
+    file.seek(0, os.SEEK_END)
+    try:
+        while True:
+            data = file.read(65536)
+            if data:
+                yield data
+                continue
+
+            if os.path.exists(path) and os.stat(path).st_ino != os.fstat(file.fileno()).st_ino:
+                file.close()
+                file = open(path, 'rb')
+                continue
+
+            if not is_running():
+                return
+            time.sleep(interval)
+    finally:
+        file.close()
+
+
+if __name__ == '__main__':
+    write_log(sys.argv[1])
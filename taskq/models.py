@@ -1,14 +1,39 @@
 #!/usr/bin/env python3
 import os
+import time
+import random
 import peewee
 import datetime
+import functools
 import click
+from playhouse.migrate import SqliteMigrator, migrate
+from playhouse.sqlite_ext import AutoIncrementField
+from taskq.settings import (TASKQ_DB_PROFILE, TASKQ_DB_PROFILES,
+                            TASKQ_DB_RETRIES, TASKQ_DB_RETRY_DELAY)
 from taskq.utils import Configuration
 
 # Criamos o banco de dados
 config = Configuration()
 ENV = config.loadEnv()
-db = peewee.SqliteDatabase(ENV['db_path'])
+db = peewee.SqliteDatabase(ENV['db_path'],
+                           pragmas=TASKQ_DB_PROFILES[TASKQ_DB_PROFILE])
+
+
+def retry_on_lock(func):
+    """Retries a write with exponential backoff while the database is locked."""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        for attempt in range(TASKQ_DB_RETRIES):
+            try:
+                return func(*args, **kwargs)
+            except peewee.OperationalError as error:
+                message = str(error)
+                if ('locked' not in message and 'busy' not in message
+                        or attempt == TASKQ_DB_RETRIES - 1):
+                    raise
+                time.sleep(TASKQ_DB_RETRY_DELAY * 2 ** attempt * (1 + random.random()))
+
+    return wrapper
 
 
 class BaseModel(peewee.Model):
@@ -21,11 +46,20 @@ class BaseModel(peewee.Model):
         database = db
 
 
+STATUS = ('blocked', 'waiting', 'running', 'canceling', 'complete', 'failed', 'canceled',
+          'oom_killed', 'lost', 'broken', 'exited')
+
+# Tasks in these states have not finished yet.
+ACTIVE = ('blocked', 'waiting', 'running', 'canceling')
+
+
 class Queue(BaseModel):
 
     """
     Classe que representa a tabela Author
     """
+    # The IDs of archived tasks are never given again, see AUTOINCREMENT.
+    id = AutoIncrementField()
     # A tabela possui apenas o campo 'name', que receberá o nome do autor sera unico
     user_id = peewee.IntegerField(null=True)
     user_name = peewee.TextField(null=True)
@@ -33,15 +67,49 @@ class Queue(BaseModel):
     context = peewee.TextField(null=True)
     output = peewee.TextField(null=True)
     pid = peewee.IntegerField(null=True)
-    is_waiting = peewee.BooleanField(default=True)
-    is_running = peewee.BooleanField(default=False)
-    is_broken = peewee.BooleanField(default=False)
-    is_complete = peewee.BooleanField(default=False)
-    is_canceled = peewee.BooleanField(default=False)
+    pid_start = peewee.BigIntegerField(null=True)
+    cpus = peewee.IntegerField(default=1)
+    mem = peewee.BigIntegerField(null=True)
+    walltime = peewee.IntegerField(null=True)
+    array_size = peewee.IntegerField(null=True)
+    parent_id = peewee.IntegerField(null=True, index=True)
+    array_index = peewee.IntegerField(null=True)
+    deps_pending = peewee.IntegerField(default=0)
+    priority = peewee.IntegerField(default=0)
+    preemptible = peewee.BooleanField(default=False)
+    retries = peewee.IntegerField(default=0)
+    retry_backoff = peewee.IntegerField(null=True)
+    attempts = peewee.IntegerField(default=0)
+    not_before = peewee.DateTimeField(null=True, index=True)
+    status = peewee.CharField(default='waiting', choices=[(s, s) for s in STATUS])
     created_at = peewee.DateTimeField(default=datetime.datetime.now)
     started_at = peewee.DateTimeField(null=True)
     completed_at = peewee.DateTimeField(null=True)
     canceled_at = peewee.DateTimeField(null=True)
+    # Resource usage of the task and its children, collected when it is reaped.
+    utime = peewee.FloatField(null=True)
+    stime = peewee.FloatField(null=True)
+    maxrss = peewee.BigIntegerField(null=True)
+    inblock = peewee.BigIntegerField(null=True)
+    oublock = peewee.BigIntegerField(null=True)
+    nvcsw = peewee.BigIntegerField(null=True)
+    nivcsw = peewee.BigIntegerField(null=True)
+    # Exit code of the task, or the signal that killed it.
+    exit_code = peewee.IntegerField(null=True)
+    exit_signal = peewee.IntegerField(null=True)
+
+    class Meta:
+        indexes = (
+            (('user_id', 'status'), False),
+        )
+
+
+Queue.add_index(Queue.status, Queue.priority.desc(), Queue.created_at)
+# Oldest waiting tasks, which priority aging may move ahead.
+Queue.add_index(Queue.status, Queue.created_at)
+# The same for each user with fair share.
+Queue.add_index(Queue.user_id, Queue.status, Queue.priority.desc(), Queue.created_at)
+Queue.add_index(Queue.user_id, Queue.status, Queue.created_at)
 
 
 class AbortQueue(BaseModel):
@@ -49,18 +117,64 @@ class AbortQueue(BaseModel):
     """
     Classe que representa a tabela Author
     """
+    id = AutoIncrementField()
     # A tabela possui apenas o campo 'name', que receberá o nome do autor sera unico
     user_id = peewee.IntegerField(null=True)
     user_name = peewee.TextField(null=True)
     pid = peewee.IntegerField(null=True)
     task_id = peewee.IntegerField(null=True)
-    is_waiting = peewee.BooleanField(default=True)
+    is_waiting = peewee.BooleanField(default=True, index=True)
     is_complete = peewee.BooleanField(default=False)
+    # Preemptions put the task back in the queue instead of canceling it.
+    requeue = peewee.BooleanField(default=False)
     created_at = peewee.DateTimeField(default=datetime.datetime.now)
     started_at = peewee.DateTimeField(null=True)
     completed_at = peewee.DateTimeField(null=True)
 
 
+class TaskArray(BaseModel):
+
+    """
+    Compact state of a job array. The elements before next_index have been
+    expanded into Queue rows, the others are still waiting.
+    """
+    task_id = peewee.IntegerField(unique=True)
+    start = peewee.IntegerField()
+    stop = peewee.IntegerField()
+    next_index = peewee.IntegerField()
+    running = peewee.IntegerField(default=0)
+    complete = peewee.IntegerField(default=0)
+    canceled = peewee.IntegerField(default=0)
+    failed = peewee.IntegerField(default=0)
+
+
+class Dependency(BaseModel):
+
+    """
+    Edge of the task graph: task_id is blocked until depends_on finishes, and
+    with kind 'ok' it is canceled if depends_on does not complete.
+    """
+    task_id = peewee.IntegerField()
+    depends_on = peewee.IntegerField(index=True)
+    kind = peewee.CharField(default='any')
+
+    class Meta:
+        # The pending edges of each dependent are counted a level at a time.
+        indexes = (
+            (('task_id', 'depends_on'), False),
+        )
+
+
+class Usage(BaseModel):
+
+    """
+    Decayed CPU seconds consumed by each user, used by the fair-share policy.
+    """
+    user_id = peewee.IntegerField(unique=True)
+    usage = peewee.FloatField(default=0)
+    updated_at = peewee.DateTimeField(default=datetime.datetime.now)
+
+
 class Variable(BaseModel):
 
     """
@@ -77,6 +191,121 @@ class Variable(BaseModel):
         return super(Variable, self).save(*args, **kwargs)
 
 
+class Lease(BaseModel):
+
+    """
+    Lease held by the leading dispatcher, see taskq.lease.
+    """
+    name = peewee.TextField(unique=True)
+    holder = peewee.TextField(null=True)
+    expires_at = peewee.DateTimeField(null=True)
+    renewed_at = peewee.DateTimeField(null=True)
+
+
+class ArchiveIndex(BaseModel):
+
+    """
+    Batch of finished rows of Queue or AbortQueue, as told by kind, moved to
+    the archive file path, see taskq.archive. A row with an ID between
+    first_id and last_id may be in it.
+    """
+    kind = peewee.CharField()
+    path = peewee.TextField()
+    first_id = peewee.IntegerField()
+    last_id = peewee.IntegerField()
+    rows = peewee.IntegerField()
+    archived_at = peewee.DateTimeField(default=datetime.datetime.now)
+
+    class Meta:
+        indexes = (
+            (('kind', 'first_id', 'last_id'), False),
+        )
+
+
+MODELS = (Queue, AbortQueue, Variable, Usage, TaskArray, Dependency, Lease, ArchiveIndex)
+
+
+# Boolean flags replaced by Queue.status, in increasing order of precedence.
+LEGACY_FLAGS = (
+    ('is_waiting', 'waiting'),
+    ('is_running', 'running'),
+    ('is_complete', 'complete'),
+    ('is_broken', 'broken'),
+    ('is_canceled', 'canceled'),
+)
+
+
+def migrate_db():
+    """Brings a database created by an older TaskQ to the current schema."""
+    migrator = SqliteMigrator(db)
+    operations = []
+    with db.atomic():
+        for model in MODELS:
+            table = model._meta.table_name
+            if not db.table_exists(table):
+                model.create_table()
+                continue
+
+            columns = [column.name for column in db.get_columns(table)]
+            for name, field in model._meta.fields.items():
+                if field.column_name not in columns:
+                    operations.append(migrator.add_column(table, field.column_name, field))
+
+        migrate(*operations)
+
+        columns = [column.name for column in db.get_columns('queue')]
+        legacy = [column for column, status in LEGACY_FLAGS if column in columns]
+        for column, status in LEGACY_FLAGS:
+            if column in legacy:
+                db.execute_sql('UPDATE queue SET status = ? WHERE {} = 1'.format(column), (status,))
+        if legacy:
+            migrate(*[migrator.drop_column('queue', column) for column in legacy])
+
+        rebuilt = add_autoincrement(Queue, 'queue') + add_autoincrement(AbortQueue, 'abort')
+
+        for model in MODELS:
+            model._schema.create_indexes(safe=True)
+
+    return len(operations) + len(legacy) + rebuilt
+
+
+def add_autoincrement(model, kind):
+    """Rebuilds the table of model with an AUTOINCREMENT key, which older
+    versions did not have, so the IDs of its archived rows are not given
+    again. Returns 1 when it was rebuilt."""
+    table = model._meta.table_name
+    sql = db.execute_sql("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?",
+                         (table,)).fetchone()[0]
+    if 'AUTOINCREMENT' in sql.upper():
+        return 0
+
+    old = table + '_old'
+    db.execute_sql('ALTER TABLE "{}" RENAME TO "{}"'.format(table, old))
+    # The indexes follow the renamed table, their names are needed again.
+    indexes = db.execute_sql("SELECT name FROM sqlite_master WHERE type = 'index' "
+                             "AND tbl_name = ? AND sql IS NOT NULL", (old,)).fetchall()
+    for name, in indexes:
+        db.execute_sql('DROP INDEX "{}"'.format(name))
+    model.create_table()
+    columns = ', '.join('"{}"'.format(column.name) for column in db.get_columns(old))
+    db.execute_sql('INSERT INTO "{}" ({}) SELECT {} FROM "{}"'.format(table, columns, columns, old))
+    db.execute_sql('DROP TABLE "{}"'.format(old))
+
+    # IDs of archived rows above the ones left were given back already, the
+    # next ones start after them.
+    archived = (ArchiveIndex.select(peewee.fn.MAX(ArchiveIndex.last_id))
+                            .where(ArchiveIndex.kind == kind)
+                            .scalar())
+    if archived is not None:
+        updated = db.execute_sql('UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = ?',
+                                 (archived, table)).rowcount
+        if not updated:
+            db.execute_sql('INSERT INTO sqlite_sequence (name, seq) VALUES (?, ?)',
+                           (table, archived))
+
+    return 1
+
+
 if __name__ == '__main__':
     try:
         Queue.create_table()
@@ -85,5 +314,15 @@ if __name__ == '__main__':
         click.echo("Table 'Variable' created successfully!")
         AbortQueue.create_table()
         click.echo("Table 'AbortQueue' created successfully!")
+        Usage.create_table()
+        click.echo("Table 'Usage' created successfully!")
+        TaskArray.create_table()
+        click.echo("Table 'TaskArray' created successfully!")
+        Dependency.create_table()
+        click.echo("Table 'Dependency' created successfully!")
+        Lease.create_table()
+        click.echo("Table 'Lease' created successfully!")
+        ArchiveIndex.create_table()
+        click.echo("Table 'ArchiveIndex' created successfully!")
     except peewee.OperationalError:
         click.echo("Table 'Queue' already exists!")
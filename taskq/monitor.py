@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+import os
+import time
+import collections
+from taskq.settings import TASKQ_SAMPLE_BUFFER
+
+CLK_TCK = os.sysconf('SC_CLK_TCK')
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+
+def read_stat(pid):
+    """Returns (session, cpu ticks, rss bytes, threads) of a process, or None
+    when it is gone."""
+    try:
+        with open('/proc/{}/stat'.format(pid), 'rb') as file:
+            data = file.read()
+    except OSError:
+        return None
+
+    # The command name may hold spaces and parentheses, the fields start
+    # after the last ')'.
+    fields = data[data.rindex(b')') + 2:].split()
+    session = int(fields[3])
+    ticks = int(fields[11]) + int(fields[12])
+    threads = int(fields[17])
+    rss = int(fields[21]) * PAGE_SIZE
+
+    return session, ticks, rss, threads
+
+
+def get_start_time(pid):
+    """Start time of a process in clock ticks after boot, None when it is
+    gone. Together with the pid it identifies a process."""
+    try:
+        with open('/proc/{}/stat'.format(pid), 'rb') as file:
+            data = file.read()
+    except OSError:
+        return None
+
+    fields = data[data.rindex(b')') + 2:].split()
+    # Zombies are gone for our purpose.
+    if fields[0] == b'Z':
+        return None
+
+    return int(fields[19])
+
+
+class Sampler:
+    """Samples the processes of the running tasks from /proc. Tasks lead
+    their own session, so a task's processes are the ones in the session
+    whose id is the task's pid."""
+
+    def __init__(self):
+        self.samples = {}
+        self.ticks = {}
+        self.sampled_at = None
+
+    def sample(self, tasks):
+        """Takes a sample of every task in tasks, a {task id: pid} dict."""
+        now = time.monotonic()
+        sessions = {pid: task_id for task_id, pid in tasks.items()}
+        totals = {task_id: [0, 0, 0] for task_id in tasks}
+        ticks = {}
+
+        for name in os.listdir('/proc'):
+            if not name.isdigit():
+                continue
+
+            stat = read_stat(name)
+            if stat is None or stat[0] not in sessions:
+                continue
+
+            session, cpu, rss, threads = stat
+            task_id = sessions[session]
+            pid = int(name)
+            ticks[pid] = cpu
+            total = totals[task_id]
+            # Processes started since the last sample are charged all their
+            # CPU time, the others only what they used meanwhile.
+            total[0] += cpu - self.ticks.get(pid, 0)
+            total[1] += rss
+            total[2] += threads
+
+        elapsed = now - self.sampled_at if self.sampled_at is not None else None
+        for task_id, (cpu, rss, threads) in totals.items():
+            if task_id in self.samples and elapsed:
+                percent = 100.0 * cpu / CLK_TCK / elapsed
+            else:
+                percent = None
+                self.samples[task_id] = collections.deque(maxlen=TASKQ_SAMPLE_BUFFER)
+            self.samples[task_id].append((time.time(), percent, rss, threads))
+
+        for task_id in set(self.samples) - set(tasks):
+            del self.samples[task_id]
+
+        self.ticks = ticks
+        self.sampled_at = now
+
+    def summary(self):
+        """Latest sample of each task, with the average CPU and peak RSS over
+        the samples kept."""
+        summary = {}
+        for task_id, samples in self.samples.items():
+            sampled_at, percent, rss, threads = samples[-1]
+            percents = [sample[1] for sample in samples if sample[1] is not None]
+            summary[task_id] = {
+                'sampled_at': sampled_at,
+                'cpu': percent,
+                'avg_cpu': sum(percents) / len(percents) if percents else None,
+                'rss': rss,
+                'peak_rss': max(sample[2] for sample in samples),
+                'threads': threads,
+            }
+
+        return summary
@@ -1,85 +1,439 @@
 #!/usr/bin/env python3
 import os
 import pwd
-import tabulate
+import shlex
+import signal
 import tempfile
+import peewee
+import contextlib
 import datetime
 from pathlib import Path
-from subprocess import Popen
-from taskq.settings import TASKQ_SLOTS
-from taskq.models import Queue, Variable, AbortQueue
-from taskq.utils import Configuration
-
-# Criamos o banco de dados
-config = Configuration()
-ENV = config.loadEnv()
+from subprocess import Popen, STDOUT
+from taskq.settings import (TASKQ_SLOTS, TASKQ_SCHEDULER_WINDOW, TASKQ_FAIRSHARE,
+                            TASKQ_INSERT_CHUNK, TASKQ_ABORT_GRACE, TASKQ_RETRY_BACKOFF,
+                            TASKQ_LOST_POLICY, TASKQ_PRIORITY_AGING, TASKQ_PREEMPTION)
+from taskq.models import (db, Queue, Variable, AbortQueue, Usage, TaskArray, Dependency,
+                          ACTIVE, ENV, retry_on_lock)
+from taskq.scheduler import Scheduler, decay, get_cpu_seconds, get_priority
+from taskq.logs import get_log_path, start_writer
+from taskq.limits import get_limits
+from taskq.monitor import get_start_time
+from taskq.formats import render
+from taskq.archive import Archiver
+from taskq.utils import (notify_dispatcher, get_capacity, get_resource_usage, format_size,
+                         get_returncode, decode_returncode)
+
+
+# Task IDs per statement, below the SQLite limit of variables.
+ID_CHUNK = 500
+# Edges from the tasks in temp.finished, see release_dependents. Rendering
+# statements over thousands of IDs costs more in peewee than in SQLite.
+FINISHED_EDGES = 'FROM dependency AS d JOIN temp.finished AS f ON d.depends_on = f.id WHERE {}'
+
+
+def get_status_path(env, task_id):
+    return os.path.join(env['taskq_home_path'], 'status', '{}'.format(task_id))
+
+
+def read_status(task_id):
+    """The exit status a task wrote when it ended, None when it did not, as
+    when it was killed. The file is removed."""
+    path = get_status_path(ENV, task_id)
+    try:
+        with open(path) as file:
+            return int(file.read())
+    except (OSError, ValueError):
+        return None
+    finally:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def get_event(task_id, user_id, status):
+    return {
+        'task_id': task_id,
+        'user_id': user_id,
+        'status': status,
+        'time': datetime.datetime.now().isoformat(),
+    }
 
 class TaskCreator:
-    def __init__(self, command, context, user_id, user_name):
+    def __init__(self, command, context, user_id, user_name, cpus=1, mem=None,
+                 walltime=None, array=None, after=(), after_ok=(), retries=0,
+                 retry_backoff=None, priority=0, preemptible=False):
         self.command = command
         self.context = context
         self.user_id = user_id
         self.user_name = user_name
-
-    def add_to_queue(self):
-        task = {
+        self.cpus = cpus
+        self.mem = mem
+        self.walltime = walltime
+        self.array = array
+        self.dependencies = ([(task_id, 'any') for task_id in after or ()]
+                             + [(task_id, 'ok') for task_id in after_ok or ()])
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        self.priority = priority
+        self.preemptible = preemptible
+
+    def get_task(self, command):
+        return {
             'user_id': self.user_id,
             'user_name': self.user_name,
-            'command': self.command,
+            'command': command,
             'context': self.context,
+            'cpus': self.cpus,
+            'mem': self.mem,
+            'walltime': self.walltime,
+            'retries': self.retries,
+            'retry_backoff': self.retry_backoff,
+            'priority': self.priority,
+            'preemptible': self.preemptible,
         }
-        task_id = Queue.insert(task).execute()
+
+    def get_pending(self):
+        """Counts the dependencies that have not finished yet, None if one of
+        them does not exist or can not complete anymore."""
+        task_ids = [task_id for task_id, kind in self.dependencies]
+        status = {task.id: task.status for task in
+                    Queue.select(Queue.id, Queue.status).where(Queue.id.in_(task_ids))}
+
+        pending = 0
+        for task_id, kind in self.dependencies:
+            if task_id not in status:
+                return None
+            if status[task_id] in ACTIVE:
+                pending += 1
+            elif kind == 'ok' and status[task_id] != 'complete':
+                return None
+
+        return pending
+
+    def add_dependencies(self, first_id, last_id):
+        pending = self.get_pending()
+        if pending is None:
+            raise ValueError('the dependencies can not be satisfied anymore.')
+
+        (Queue.update(deps_pending=pending, status='blocked' if pending else 'waiting')
+              .where(Queue.id.between(first_id, last_id))
+              .execute()
+          )
+        for chunk in peewee.chunked(range(first_id, last_id + 1), TASKQ_INSERT_CHUNK):
+            edges = [{'task_id': task_id, 'depends_on': depends_on, 'kind': kind}
+                     for task_id in chunk for depends_on, kind in self.dependencies]
+            Dependency.insert_many(edges).execute()
+
+    @retry_on_lock
+    def add_to_queue(self):
+        task = self.get_task(self.command)
+        if self.array is not None:
+            task['array_size'] = self.array[1] - self.array[0] + 1
+
+        # Checking the dependencies and inserting the task is atomic, so none
+        # of them can finish in between unnoticed.
+        with db.atomic('IMMEDIATE'):
+            task_id = Queue.insert(task).execute()
+            if self.array is not None:
+                start, stop = self.array
+                TaskArray.insert({
+                    'task_id': task_id,
+                    'start': start,
+                    'stop': stop,
+                    'next_index': start,
+                }).execute()
+            if self.dependencies:
+                self.add_dependencies(task_id, task_id)
+        notify_dispatcher(ENV, {'op': 'wake'})
 
         return task_id
 
+    def add_many(self, commands):
+        """Adds every command with the settings of this creator in a single
+        transaction, returning the first and last task IDs."""
+        task = self.get_task(None)
+        for name, field in Queue._meta.fields.items():
+            if name not in task and field.default is not None:
+                task[name] = field.default() if callable(field.default) else field.default
+        task['created_at'] = str(task['created_at'])
+        columns = list(task)
+        position = columns.index('command')
+
+        # Rendering one INSERT per row through peewee costs more than SQLite
+        # itself, so the statement is prepared once and fed by executemany.
+        sql = 'INSERT INTO "{}" ({}) VALUES ({})'.format(
+            Queue._meta.table_name,
+            ', '.join('"{}"'.format(column) for column in columns),
+            ', '.join('?' for column in columns))
+        values = list(task.values())
+
+        count = 0
+        # The write lock is held for the whole transaction, so the new IDs
+        # follow each other without gaps. Only taking it is retried, as the
+        # commands may be a stream that can not be read twice.
+        with contextlib.ExitStack() as stack:
+            retry_on_lock(stack.enter_context)(db.atomic('IMMEDIATE'))
+            for chunk in peewee.chunked(commands, TASKQ_INSERT_CHUNK):
+                rows = []
+                for command in chunk:
+                    values[position] = command
+                    rows.append(tuple(values))
+                db.cursor().executemany(sql, rows)
+                count += len(rows)
+            first_id = db.execute_sql('SELECT last_insert_rowid()').fetchone()[0] - count + 1
+            if self.dependencies and count:
+                self.add_dependencies(first_id, first_id + count - 1)
+
+        if count == 0:
+            return None
+
+        notify_dispatcher(ENV, {'op': 'wake'})
+
+        return first_id, first_id + count - 1
 
 
 class TaskHandler:
-    def __init__(self):
+    def __init__(self, capture=True):
         self.subprocess = None
         self.pid = None
         self.next = None
         self.slot_available = None
+        self.slots = 0
+        self.running = {}
+        self.adopted = {}
+        self.lease = None
+        self.capture = capture
+        self.writers = []
+        self.events = []
+        self.scheduler = Scheduler(get_capacity())
+        self.limits = get_limits()
 
     def handle(self):
         self.check_slot_availability()
         if self.slot_available == True:
-            self.get_next()
-            if self.next:
+            for task in self.get_next():
+                self.next = task
                 self.execute()
-                self.update()
-                return self.message()
-            else:
-                return self.message()
-        else:
-            return self.message()
+        if TASKQ_PREEMPTION:
+            self.preempt()
+
+        return self.message()
+
+
+    def get_running(self):
+        # Job arrays are 'running' while their last elements run, but only the
+        # elements hold resources.
+        return (Queue.select()
+                    .where((Queue.status.in_(['running', 'canceling']))
+                           & (Queue.array_size.is_null()))
+                )
 
 
     def get_next(self):
-        self.next = (Queue.select()
-                        .where(Queue.is_waiting == True)
+        running = list(self.get_running())
+        waiting = self.get_waiting(running)
+
+        selected = self.scheduler.select(waiting, running, self.slots)
+        self.next = selected[0] if selected else None
+
+        return selected
+
+
+    def get_waiting(self, running):
+        """The waiting tasks in the order they should start."""
+        if TASKQ_FAIRSHARE:
+            return self.scheduler.order(self.get_waiting_by_user(),
+                                        TaskQHelper.get_usage(),
+                                        running)
+
+        return self.expand_arrays(self.get_window(self.is_eligible()))
+
+
+    def get_window(self, where):
+        """The waiting tasks considered by the scheduler, by priority. With
+        aging, the oldest ones are considered too since they may have
+        gained enough priority."""
+        tasks = list(Queue.select()
+                        .where(where)
+                        .order_by(Queue.priority.desc(), Queue.created_at.asc())
+                        .limit(TASKQ_SCHEDULER_WINDOW)
+                    )
+        if TASKQ_PRIORITY_AGING:
+            task_ids = {task.id for task in tasks}
+            oldest = (Queue.select()
+                        .where(where)
                         .order_by(Queue.created_at.asc())
-                        .first()
+                        .limit(TASKQ_SCHEDULER_WINDOW)
                     )
+            tasks += [task for task in oldest if task.id not in task_ids]
+            now = datetime.datetime.now()
+            tasks.sort(key=lambda task: (-get_priority(task, now), task.created_at))
+
+        return tasks
+
+
+    def preempt(self):
+        """Preempts lower priority tasks for the first waiting task that did
+        not start, unless a preemption is still in progress."""
+        in_progress = (AbortQueue.select()
+                            .where((AbortQueue.requeue == True)
+                                   & (AbortQueue.is_complete == False))
+                            .exists()
+                        )
+        if in_progress:
+            return
+
+        running = list(self.get_running())
+        waiting = self.get_waiting(running)
+        if not waiting:
+            return
+
+        for task in self.scheduler.preempt(waiting[0], running, TASKQ_SLOTS - len(running)):
+            TaskQHelper.abort_task(task.id, requeue=True)
+
+
+    def is_eligible(self):
+        """Waiting tasks, but the retries whose backoff has not passed yet."""
+        return ((Queue.status == 'waiting')
+                & (Queue.not_before.is_null()
+                   | (Queue.not_before <= datetime.datetime.now())))
+
+
+    def get_retry_timeout(self):
+        """Seconds until the next retry can start, None if there is none."""
+        now = datetime.datetime.now()
+        task = (Queue.select(Queue.not_before)
+                    .where((Queue.not_before > now) & (Queue.status == 'waiting'))
+                    .order_by(Queue.not_before.asc())
+                    .first()
+                )
+        if task is None:
+            return None
 
+        return (task.not_before - now).total_seconds()
 
-    def check_slot_availability(self):
-        check = (Queue.select()
-                        .where(Queue.is_running == True)
-                        .count()
+
+    def get_waiting_by_user(self):
+        users = (Queue.select(Queue.user_id)
+                        .where(self.is_eligible())
+                        .distinct()
                     )
 
-        if check >= TASKQ_SLOTS:
+        waiting = {}
+        for user in users:
+            waiting[user.user_id] = self.expand_arrays(
+                self.get_window(self.is_eligible() & (Queue.user_id == user.user_id)))
+
+        return waiting
+
+
+    def expand_arrays(self, tasks):
+        """Replaces each job array by its next elements, at most one per free
+        slot. The elements are only saved when they are executed."""
+        tasks = list(tasks)
+        task_ids = [task.id for task in tasks if task.array_size]
+        if not task_ids:
+            return tasks
+
+        arrays = {array.task_id: array for array in
+                    TaskArray.select().where(TaskArray.task_id.in_(task_ids))}
+
+        expanded = []
+        for task in tasks:
+            array = arrays.get(task.id)
+            if array is None:
+                expanded.append(task)
+                continue
+
+            # Without free slots, the first element is still needed to
+            # decide on preemption.
+            stop = min(array.stop, array.next_index + max(self.slots, 1) - 1)
+            for index in range(array.next_index, stop + 1):
+                expanded.append(self.get_element(task, index))
+
+        return expanded
+
+
+    def get_element(self, task, index):
+        fields = ('user_id', 'user_name', 'context', 'cpus', 'mem', 'walltime',
+                  'priority', 'preemptible', 'retries', 'retry_backoff', 'created_at')
+        element = Queue(**{name: getattr(task, name) for name in fields})
+        element.command = task.command.replace('{i}', str(index))
+        element.parent_id = task.id
+        element.array_index = index
+
+        return element
+
+
+    def materialize(self):
+        """Saves the array element about to be executed and moves the array
+        cursor past it. Returns False if the array was canceled meanwhile."""
+        with db.atomic():
+            parent = Queue.get_by_id(self.next.parent_id)
+            if parent.status != 'waiting':
+                return False
+            array = TaskArray.get(TaskArray.task_id == parent.id)
+            if array.next_index != self.next.array_index:
+                return False
+
+            self.next.save()
+            (TaskArray.update(next_index=self.next.array_index + 1,
+                              running=TaskArray.running + 1)
+                      .where(TaskArray.task_id == parent.id)
+                      .execute()
+                  )
+            array = TaskArray.get(TaskArray.task_id == parent.id)
+            if array.next_index > array.stop:
+                parent.status = 'running'
+                parent.started_at = datetime.datetime.now()
+                parent.save()
+
+        return True
+
+
+    def check_slot_availability(self):
+        check = self.get_running().count()
+
+        self.slots = TASKQ_SLOTS - check
+        if self.slots <= 0:
             self.slot_available = False
         else:
             self.slot_available = True
 
 
+    def claim(self):
+        """Marks the next task as running before it is started, returning
+        False if it can not start anymore. With a lease, this is only done
+        while it is held, so two dispatchers never start the same task."""
+        with db.atomic('IMMEDIATE'):
+            if self.lease is not None and not self.lease.is_held():
+                return False
+            if self.next.id is None:
+                return self.materialize()
+
+            return (Queue.update(status='running', started_at=datetime.datetime.now())
+                         .where((Queue.id == self.next.id) & (Queue.status == 'waiting'))
+                         .execute()
+                     ) > 0
+
+
     def execute(self):
+        if not self.claim():
+            return
 
+        # The task writes its own exit status, so a dispatcher that adopts it
+        # later can tell how it ended.
+        status_path = get_status_path(ENV, self.next.id)
+        os.makedirs(os.path.dirname(status_path), exist_ok=True)
         script = '''#!/bin/sh
+        (
         {}
-        '''.format(self.next.command)
+        )
+        status=$?
+        echo $status > {}
+        exit $status
+        '''.format(self.next.command, shlex.quote(status_path))
 
         print(script)
 
@@ -87,50 +441,233 @@ class TaskHandler:
         script_file.write(script)
         script_file.flush()
 
+        preexec = None
+        if self.limits is not None:
+            try:
+                preexec = self.limits.prepare(self.next)
+            except OSError as error:
+                print('Limits of task {} not enforced: {}'.format(self.next.id, error))
+
+        # Each task leads its own session and process group, so it can be
+        # aborted together with everything it starts.
+        if self.capture:
+            self.next.output = get_log_path(ENV, self.next.id)
+            output, writer = start_writer(self.next.output)
+            self.writers.append(writer)
+            try:
+                proc = Popen(['sh', script_file.name], stdout=output, stderr=STDOUT,
+                             close_fds=True, start_new_session=True, preexec_fn=preexec)
+            finally:
+                os.close(output)
+        else:
+            proc = Popen(['sh', script_file.name], close_fds=True, start_new_session=True,
+                         preexec_fn=preexec)
+        self.next.status = 'running'
+        self.next.pid = proc.pid
+        self.next.pid_start = get_start_time(proc.pid)
+        self.next.started_at = datetime.datetime.now()
+        self.next.save()
+        self.events.append(get_event(self.next.id, self.next.user_id, 'running'))
+
+        self.pid = proc.pid
+        self.running[proc.pid] = (self.next, proc, script_file)
+
+
+    def reap(self, block=False):
+        """Collects finished tasks, returning how many slots were freed."""
+        flags = 0 if block else os.WNOHANG
+        reaped = 0
+        for pid in list(self.running):
+            try:
+                done, status, rusage = os.wait4(pid, flags)
+            except ChildProcessError:
+                done, status, rusage = pid, 0, None
+
+            if done == 0:
+                continue
+
+            task, proc, script_file = self.running.pop(pid)
+            proc.returncode = get_returncode(status)
+            script_file.close()
+            read_status(task.id)
+            self.finish(task, proc.returncode, rusage)
+            reaped += 1
+
+        for pid, task in list(self.adopted.items()):
+            if get_start_time(pid) == task.pid_start:
+                continue
+
+            # Adopted tasks are not our children, only the status they wrote
+            # tells how they ended.
+            del self.adopted[pid]
+            self.finish(task, read_status(task.id))
+            reaped += 1
+
+        # The log writers exit after their task, once its output is written.
+        self.writers = [writer for writer in self.writers if writer.poll() is None]
+
+        return reaped
+
+
+    def finish(self, task, returncode, rusage=None):
+        """Records how a task ended, even when it was aborted meanwhile."""
+        returncode = decode_returncode(returncode)
+        if returncode is not None:
+            result = {'exit_code': returncode if returncode >= 0 else None,
+                      'exit_signal': -returncode if returncode < 0 else None}
+            if rusage is not None:
+                result.update(get_resource_usage(rusage))
+            (Queue.update(**result)
+                  .where(Queue.id == task.id)
+                  .execute()
+              )
+        self.update(task, returncode)
+
+
+    def recover(self):
+        """Reconciles the tasks left running by a previous dispatcher with
+        /proc: the ones still alive are adopted, the ones that ended meanwhile
+        are finished with the status they wrote, the others are handled as set
+        by TASKQ_LOST_POLICY."""
+        tasks = (Queue.select()
+                    .where((Queue.status == 'running')
+                           & (Queue.array_size.is_null()))
+                )
+        for task in tasks:
+            if task.pid in self.running:
+                continue
+
+            start = get_start_time(task.pid) if task.pid else None
+            # Rows from older versions have no start time to compare.
+            if start is not None and task.pid_start in (start, None):
+                task.pid_start = start
+                self.adopted[task.pid] = task
+                continue
+
+            returncode = read_status(task.id)
+            if returncode is not None:
+                self.finish(task, returncode)
+            else:
+                self.lose(task)
 
-        with Popen(['sh', script_file.name], close_fds=True) as proc:
-            self.next.is_waiting = False
-            self.next.is_running = True
-            self.next.pid = proc.pid
-            self.next.started_at = datetime.datetime.now()
-            self.next.save()
-            proc.wait()
+        return len(self.adopted)
 
 
-    def update(self):
-        self.next.is_complete = True
-        self.next.is_running = False
-        self.next.completed_at = datetime.datetime.now()
-        self.next.save()
+    def lose(self, task):
+        if self.limits is not None:
+            self.limits.release(task)
+
+        if TASKQ_LOST_POLICY == 'requeue':
+            updated = (Queue.update(status='waiting', pid=None, pid_start=None, started_at=None)
+                            .where((Queue.id == task.id) & (Queue.status == 'running'))
+                            .execute()
+                        )
+            if updated:
+                self.events.append(get_event(task.id, task.user_id, 'waiting'))
+            return
+
+        updated = (Queue.update(status='lost', completed_at=datetime.datetime.now())
+                        .where((Queue.id == task.id) & (Queue.status == 'running'))
+                        .execute()
+                    )
+        if updated:
+            self.events.append(get_event(task.id, task.user_id, 'lost'))
+            self.release(task, False)
+
+
+    def update(self, task, returncode=0):
+        """Finishes a task that exited with returncode, None when it is
+        unknown. Those end as exited, which does not count as complete."""
+        if returncode is None:
+            task.status = 'exited'
+        else:
+            task.status = 'complete' if returncode == 0 else 'failed'
+        if self.limits is not None:
+            if self.limits.oom_killed(task):
+                task.status = 'oom_killed'
+            self.limits.release(task)
+
+        task.completed_at = datetime.datetime.now()
+        if task.status == 'failed' and task.attempts < task.retries:
+            self.retry(task)
+            return
+
+        # The row may have been canceled in the meantime by the abort handler.
+        updated = (Queue.update(status=task.status, completed_at=task.completed_at)
+                        .where((Queue.id == task.id) & (Queue.status == 'running'))
+                        .execute()
+                    )
+        if updated:
+            ok = task.status == 'complete'
+            self.events.append(get_event(task.id, task.user_id, task.status))
+            TaskQHelper.charge_usage(task)
+            self.release(task, ok)
+
+
+    def release(self, task, ok):
+        """Follows a finished task to its dependents and its array,
+        reporting the tasks that changed with it."""
+        changes = TaskQHelper.release_dependents(task.id, ok)
+        if task.parent_id is not None:
+            TaskQHelper.update_array(task.parent_id, 'complete' if ok else 'failed', changes)
+        self.events.extend(TaskQHelper.get_events(changes))
+
+
+    def retry(self, task):
+        """Puts a failed task back in the queue, keeping its place, to start
+        again once the backoff has passed."""
+        backoff = task.retry_backoff if task.retry_backoff is not None else TASKQ_RETRY_BACKOFF
+        not_before = task.completed_at + datetime.timedelta(seconds=backoff * 2 ** task.attempts)
+        updated = (Queue.update(status='waiting', attempts=Queue.attempts + 1,
+                                not_before=not_before, pid=None, started_at=None)
+                        .where((Queue.id == task.id) & (Queue.status == 'running'))
+                        .execute()
+                    )
+        if updated:
+            self.events.append(get_event(task.id, task.user_id, 'waiting'))
+            TaskQHelper.charge_usage(task)
 
 
     def message(self):
         if self.slot_available:
             if self.next:
                 if self.pid:
-                    return 'Task with ID={} running with PID={}.'
+                    return 'Task with ID={} running with PID={}.'.format(self.next.id, self.pid)
             else:
                 return 'No elegible task to be executed.'
         else:
             return 'System is currently busy. Please, try again later.'
 
 
+def leads_group(pid):
+    """Tells if the process leads its process group, as tasks started by
+    this version do. Tasks adopted from older versions share the group of
+    their dispatcher. A group whose leader is gone may still have processes."""
+    try:
+        return os.getpgid(pid) == pid
+    except ProcessLookupError:
+        return True
+
+
 class AbortHandler:
     def __init__(self):
         self.subprocess = None
         self.pid = None
         self.next = None
         self.slot_available = None
+        self.terminating = {}
+        self.events = []
 
     def handle(self):
 
         self.get_next()
-        if self.next:
+        while self.next:
             self.execute()
-            self.update()
-            return self.message()
-        else:
-            return self.message()
+            self.get_next()
+
+        self.check_terminating()
+
+        return self.message()
 
 
     def get_next(self):
@@ -142,38 +679,123 @@ class AbortHandler:
 
 
     def execute(self):
+        """Sends SIGTERM to the process group of the task. The task stays
+        'canceling' until the whole group is gone, see check_terminating.
+        Nothing is signaled once the task ended, its PID may be reused."""
+        self.next.is_waiting = False
+        self.next.started_at = datetime.datetime.now()
+        self.next.save()
 
-        script = '''#!/bin/sh
-        pkill -P {}
-        '''.format(self.next.pid)
+        # The task handler may have reaped the task first and completed it.
+        updated = (Queue.update(status='canceling')
+                        .where((Queue.id == self.next.task_id) & (Queue.status == 'running'))
+                        .execute()
+                    )
+        if updated:
+            self.events.append(get_event(self.next.task_id, self.next.user_id, 'canceling'))
+
+        self.pid = self.next.pid
+        deadline = datetime.datetime.now() + datetime.timedelta(seconds=TASKQ_ABORT_GRACE)
+        leader = leads_group(self.next.pid) if self.owns(self.next) else None
+        self.terminating[self.next.id] = (self.next, deadline, leader)
+        self.signal(self.next.pid, signal.SIGTERM, leader)
+
+
+    def owns(self, abort):
+        """Tells if the process with the PID of an abort is still the one of
+        its task, by its start time. Rows from older versions have none, their
+        process is taken as alive while the task is canceling."""
+        task = Queue.get_or_none(Queue.id == abort.task_id)
+        if task is None or task.pid != abort.pid:
+            return False
+        if task.pid_start is None:
+            return task.status == 'canceling'
+
+        return get_start_time(abort.pid) == task.pid_start
+
+
+    def signal(self, pid, signum, leader=True):
+        """Signals the process group of a task, or the task alone when it
+        does not lead one, returning False if it has no process left. A leader
+        of None stands for a task whose process is gone."""
+        if leader is None:
+            return False
+
+        try:
+            if not leader:
+                os.kill(pid, signum)
+                # Zombies can still be signaled.
+                return get_start_time(pid) is not None
+            os.killpg(pid, signum)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            # Only processes of other users are left, the group was reused.
+            print('Processes of PID={} belong to another user, not signaling them.'.format(pid))
+            return False
 
-        print(script)
+        return True
 
-        script_file = tempfile.NamedTemporaryFile('wt')
-        script_file.write(script)
-        script_file.flush()
 
+    def check_terminating(self):
+        """Cancels the tasks whose process group is gone and kills the ones
+        still alive after the grace period."""
+        now = datetime.datetime.now()
+        for abort_id, (abort, deadline, leader) in list(self.terminating.items()):
+            if self.signal(abort.pid, 0, leader):
+                if now >= deadline:
+                    self.signal(abort.pid, signal.SIGKILL, leader)
+                continue
+
+            del self.terminating[abort_id]
+            if abort.requeue:
+                self.requeue(abort)
+                continue
+
+            updated = (Queue.update(status='canceled', canceled_at=now)
+                            .where((Queue.id == abort.task_id) & (Queue.status == 'canceling'))
+                            .execute()
+                        )
+            if updated:
+                task = Queue.get_by_id(abort.task_id)
+                self.events.append(get_event(task.id, task.user_id, 'canceled'))
+                TaskQHelper.charge_usage(task)
+                changes = TaskQHelper.release_dependents(task.id, False)
+                if task.parent_id is not None:
+                    TaskQHelper.update_array(task.parent_id, 'canceled', changes)
+                self.events.extend(TaskQHelper.get_events(changes))
+            self.update(abort)
+
+
+    def requeue(self, abort):
+        """Puts a preempted task back in the queue, keeping its place."""
+        task = Queue.get_by_id(abort.task_id)
+        updated = (Queue.update(status='waiting', pid=None, pid_start=None, started_at=None)
+                        .where((Queue.id == task.id) & (Queue.status == 'canceling'))
+                        .execute()
+                    )
+        if updated:
+            self.events.append(get_event(task.id, task.user_id, 'waiting'))
+            TaskQHelper.charge_usage(task)
+        self.update(abort)
 
-        with Popen(['sh', script_file.name], close_fds=True) as proc:
-            self.next.is_waiting = False
-            self.next.started_at = datetime.datetime.now()
-            proc.wait()
-            self.next.save()
 
-        task = (Queue.select()
-                    .where(Queue.id == self.next.task_id)
-                    .first()
-                )
+    def resume(self):
+        """Tracks again the aborts a previous dispatcher left unfinished."""
+        started = (AbortQueue.select()
+                        .where((AbortQueue.is_waiting == False)
+                               & (AbortQueue.is_complete == False))
+                    )
+        deadline = datetime.datetime.now() + datetime.timedelta(seconds=TASKQ_ABORT_GRACE)
+        for abort in started:
+            leader = leads_group(abort.pid) if self.owns(abort) else None
+            self.terminating[abort.id] = (abort, deadline, leader)
 
-        task.is_running = False
-        task.is_canceled = True
-        task.canceled_at = datetime.datetime.now()
-        task.save()
 
-    def update(self):
-        self.next.is_complete = True
-        self.next.completed_at = datetime.datetime.now()
-        self.next.save()
+    def update(self, abort):
+        abort.is_complete = True
+        abort.completed_at = datetime.datetime.now()
+        abort.save()
 
 
     def message(self):
@@ -206,14 +828,47 @@ class TaskQHelper:
             return None
 
     @classmethod
-    def abort_task(cls, task_id):
+    def cancel_task(cls, task_id, user_id):
+        """Aborts a task on behalf of user_id, returning the reply sent to
+        the client. 'canceled' tells if the task was canceled right away,
+        which running tasks are not, and 'changes' lists the (task ID, status)
+        of the tasks canceled or released with it."""
+        ownership = cls.check_ownership(task_id, user_id)
+        if ownership is None:
+            return {'error': 'There is no task with ID={}.'.format(task_id)}
+        if not ownership:
+            return {'error': 'Only the task owner or the queue owner can abort the task '
+                             'with ID={}.'.format(task_id)}
+
+        task = cls.get_task(task_id)
+        changes = []
+        if cls.abort_task(task_id, changes=changes) is None:
+            return {'error': 'Task with ID={} is not running anymore.'.format(task_id)}
+
+        return {'task_id': task.id, 'user_id': task.user_id,
+                'canceled': task.status in ('waiting', 'blocked') or bool(task.array_size),
+                'changes': changes}
+
+    @classmethod
+    @retry_on_lock
+    def abort_task(cls, task_id, requeue=False, changes=None):
+        """Cancels a task, or has the abort handler stop it when it runs.
+        The (task ID, status) of the tasks canceled or released right away are
+        added to changes."""
+        if changes is None:
+            changes = []
         task = (Queue.select()
                     .where(Queue.id == task_id)
                     .first()
                 )
 
+        if task is not None and task.array_size:
+            return cls.abort_array(task, changes)
+
         if task is not None:
-            if task.is_running:
+            if task.status == 'canceling':
+                return task.id
+            elif task.status == 'running':
                 # with Popen(['pkill', '-P', str(task.pid)], close_fds=True) as proc:
                 #     proc.wait()
                 abort = {
@@ -223,34 +878,186 @@ class TaskQHelper:
                     'pid': task.pid,
                     'is_waiting': True,
                     'is_complete': False,
+                    'requeue': requeue,
                     'created_at': datetime.datetime.now(),
                 }
                 abort_id = AbortQueue.insert(abort).execute()
-                # task.is_waiting = False
-                # task.is_running = False
-                # task.is_canceled = True
+                notify_dispatcher(ENV, {'op': 'abort', 'abort_id': abort_id})
+                # task.status = 'canceled'
                 # task.canceled_at = datetime.datetime.now()
                 # task.save()
                 return task.id
-            elif not task.is_running and task.is_waiting:
-                task.is_waiting = False
-                task.is_running = False
-                task.is_canceled = True
+            elif task.status in ('waiting', 'blocked'):
+                task.status = 'canceled'
                 task.canceled_at = datetime.datetime.now()
                 task.save()
+                changes.append((task.id, 'canceled'))
+                changes.extend(cls.release_dependents(task.id, False))
+                # Only elements waiting for a retry are saved while waiting.
+                if task.parent_id is not None:
+                    cls.update_array(task.parent_id, 'canceled', changes)
+                notify_dispatcher(ENV, {'op': 'wake'})
                 return task.id
             else:
                 return None
         else:
             return None
 
+    @classmethod
+    def abort_array(cls, task, changes):
+        with db.atomic():
+            if task.status not in ACTIVE:
+                return None
+
+            array = TaskArray.get(TaskArray.task_id == task.id)
+            remaining = array.stop - array.next_index + 1
+            (TaskArray.update(next_index=array.stop + 1,
+                              canceled=TaskArray.canceled + remaining)
+                      .where(TaskArray.id == array.id)
+                      .execute()
+                  )
+            task.status = 'canceled'
+            task.canceled_at = datetime.datetime.now()
+            task.save()
+            changes.append((task.id, 'canceled'))
+            changes.extend(cls.release_dependents(task.id, False))
+
+        elements = (Queue.select(Queue.id)
+                        .where((Queue.parent_id == task.id)
+                               & (Queue.status.in_(['running', 'waiting'])))
+                    )
+        for element in elements:
+            cls.abort_task(element.id, changes=changes)
+
+        return task.id
+
+    @classmethod
+    def update_array(cls, task_id, status, changes=None):
+        """Counts a finished element and completes the array after its last
+        one, returning the status of the array when it did. The array and the
+        tasks it released are then added to changes."""
+        counter = getattr(TaskArray, status)
+        (TaskArray.update({TaskArray.running: TaskArray.running - 1,
+                           counter: counter + 1})
+                  .where(TaskArray.task_id == task_id)
+                  .execute()
+              )
+
+        array = TaskArray.get(TaskArray.task_id == task_id)
+        if array.running == 0 and array.next_index > array.stop:
+            status = 'failed' if array.failed else 'complete'
+            updated = (Queue.update(status=status, completed_at=datetime.datetime.now())
+                            .where((Queue.id == task_id) & (Queue.status == 'running'))
+                            .execute()
+                        )
+            if updated:
+                released = cls.release_dependents(task_id, status == 'complete')
+                if changes is not None:
+                    changes.append((task_id, status))
+                    changes.extend(released)
+                return status
+
+        return None
+
+    @classmethod
+    def release_dependents(cls, task_id, ok):
+        """Called when a task finishes: unblocks the tasks whose last pending
+        dependency it was, and cancels the ones that needed it to complete.
+        The graph is followed a level at a time, the finished tasks of a level
+        being kept in a temporary table so a few statements cover all of its
+        edges. Returns the (task ID, status) of the tasks that changed."""
+        changes = []
+        finished = [(task_id, ok)]
+        with db.atomic():
+            db.execute_sql('CREATE TEMP TABLE IF NOT EXISTS finished '
+                           '(id INTEGER PRIMARY KEY, ok INTEGER)')
+            while finished:
+                db.execute_sql('DELETE FROM temp.finished')
+                db.cursor().executemany('INSERT INTO temp.finished VALUES (?, ?)', finished)
+                canceled = cls.cancel_blocked()
+                changes += [(task_id, 'waiting') for task_id in cls.unblock()]
+                changes += [(task_id, 'canceled') for task_id in canceled]
+                finished = [(task_id, False) for task_id in canceled]
+
+        return changes
+
+    @classmethod
+    def unblock(cls):
+        """Counts the tasks in temp.finished as finished for the blocked
+        tasks that depend on them, returning the IDs of those with no
+        dependency left."""
+        condition = "(f.ok OR d.kind = 'any')"
+        edges = 'SELECT d.task_id ' + FINISHED_EDGES.format(condition)
+        pending = 'SELECT COUNT(*) ' + FINISHED_EDGES.format(condition + ' AND d.task_id = queue.id')
+        db.execute_sql('UPDATE queue SET deps_pending = deps_pending - ({}) '
+                       "WHERE status = 'blocked' AND id IN ({})".format(pending, edges))
+        released = "status = 'blocked' AND deps_pending <= 0 AND id IN ({})".format(edges)
+        task_ids = [row[0] for row in
+                        db.execute_sql('SELECT id FROM queue WHERE {}'.format(released))]
+        if task_ids:
+            db.execute_sql("UPDATE queue SET status = 'waiting' WHERE {}".format(released))
+
+        return task_ids
+
+    @classmethod
+    def cancel_blocked(cls):
+        """Cancels the blocked tasks that needed a failed task in
+        temp.finished to complete, returning their IDs."""
+        blocked = ("status = 'blocked' AND id IN (SELECT d.task_id {})"
+                    .format(FINISHED_EDGES.format("d.kind = 'ok' AND NOT f.ok")))
+        tasks = db.execute_sql('SELECT id, array_size FROM queue WHERE {}'.format(blocked)).fetchall()
+        if not tasks:
+            return []
+
+        db.execute_sql("UPDATE queue SET status = 'canceled', canceled_at = ? WHERE {}".format(blocked),
+                       (str(datetime.datetime.now()),))
+        arrays = [task_id for task_id, array_size in tasks if array_size]
+        if arrays:
+            for array in TaskArray.select().where(TaskArray.task_id.in_(arrays)):
+                (TaskArray.update(next_index=array.stop + 1,
+                                  canceled=TaskArray.canceled + array.stop - array.next_index + 1)
+                          .where(TaskArray.id == array.id)
+                          .execute()
+                      )
+
+        return [task_id for task_id, _ in tasks]
+
+    @classmethod
+    def get_events(cls, changes):
+        """The events of the (task ID, status) changes."""
+        users = {}
+        for chunk in peewee.chunked([task_id for task_id, _ in changes], ID_CHUNK):
+            users.update(db.execute_sql('SELECT id, user_id FROM queue WHERE id IN ({})'
+                                        .format(', '.join('?' * len(chunk))), chunk))
+
+        return [get_event(task_id, users.get(task_id), status) for task_id, status in changes]
+
+    @classmethod
+    def array_summary(cls, task_id):
+        array = (TaskArray.select()
+                    .where(TaskArray.task_id == task_id)
+                    .first()
+                )
+        if array is None:
+            return None
+
+        return {
+            'task_id': array.task_id,
+            'indexes': '{}-{}'.format(array.start, array.stop),
+            'waiting': array.stop - array.next_index + 1,
+            'running': array.running,
+            'complete': array.complete,
+            'canceled': array.canceled,
+            'failed': array.failed,
+        }
+
     @classmethod
     def reset_task(cls, task_id):
         task = (Queue.select()
                     .where(Queue.id == task_id)
                     .first()
                 )
-        if task.is_running:
+        if task.status == 'running':
             # with Popen(['pkill', '-P', str(task.pid)], close_fds=True) as proc:
             #     proc.wait()
             abort = {
@@ -263,16 +1070,14 @@ class TaskQHelper:
                 'created_at': datetime.datetime.now(),
             }
             abort_id = AbortQueue.insert(abort).execute()
-            task.is_waiting = True
-            task.is_complete = False
+            task.status = 'waiting'
             task.started_at = None
             task.completed_at = None
             task.save()
 
             return task.id
-        elif not task.is_running and not task.is_waiting:
-            task.is_waiting = True
-            task.is_complete = False
+        elif task.status != 'waiting':
+            task.status = 'waiting'
             task.started_at = None
             task.completed_at = None
             task.save()
@@ -282,99 +1087,292 @@ class TaskQHelper:
 
 
     @classmethod
-    def task_info(cls, task_id):
-        data = (Queue.select()
+    def get_task(cls, task_id):
+        return (Queue.select()
                     .where(Queue.id == task_id)
-                    .dicts()
+                    .first()
                 )
 
-        header = list(Queue._meta.fields.keys())
 
-        f = lambda x: [str(y) for y in list(x.values())]
-        rows = [f(task) for task in data]
+    @classmethod
+    def get_task_data(cls, task_id):
+        """The row of a task as a dict, with the progress of its array if it
+        is one, looked up in the archive when it has been archived. None when
+        the task does not exist."""
+        task = (Queue.select()
+                    .where(Queue.id == task_id)
+                    .dicts()
+                    .first()
+                )
+        if task is not None:
+            task['array'] = cls.array_summary(task_id)
+        else:
+            task = Archiver().find('queue', task_id)
 
-        return tabulate.tabulate(rows, header)
+        return task
 
 
     @classmethod
-    def show_queue(cls, mode):
+    def get_statuses(cls, task_ids):
+        return {task.id: task.status for task in
+                    Queue.select(Queue.id, Queue.status).where(Queue.id.in_(task_ids))}
 
+
+    @classmethod
+    def list_tasks(cls, status=None, user_id=None, limit=None, after=None):
+        """The rows of the tasks with one of the given statuses, the active
+        ones by default, of one user if user_id is given, in the order they
+        were added. A page holds up to limit tasks with an ID above after."""
         data = (Queue.select()
-                     .where(Queue.is_waiting == True)
-                     .order_by(Queue.created_at.asc())
+                     .order_by(Queue.id.asc())
+                     .limit(limit)
                      .dicts()
                 )
+        if isinstance(status, str):
+            status = [status]
+        data = data.where(Queue.status.in_(status or ACTIVE))
+        if user_id is not None:
+            data = data.where(Queue.user_id == user_id)
+        if after is not None:
+            data = data.where(Queue.id > after)
 
-        if mode == 'mine':
-            data = (Queue.select()
-                         .where(Queue.user_id == os.getuid())
-                         .order_by(Queue.created_at.asc())
-                         .dicts()
-                    )
+        return list(data)
 
-        if mode == 'all':
-            data = (Queue.select()
-                         .order_by(Queue.created_at.asc())
-                         .dicts()
-                    )
 
-        elif mode == 'done':
-             data = (Queue.select()
-                         .where(Queue.is_complete == True)
-                         .order_by(Queue.created_at.asc())
-                         .dicts()
-                    )
-        elif mode == 'running':
-             data = (Queue.select()
-                         .where(Queue.is_running == True)
-                         .order_by(Queue.created_at.asc())
-                         .dicts()
-                    )
+    @classmethod
+    def task_info(cls, task_id):
+        import tabulate
+        data = (Queue.select()
+                    .where(Queue.id == task_id)
+                    .dicts()
+                )
 
         header = list(Queue._meta.fields.keys())
 
         f = lambda x: [str(y) for y in list(x.values())]
         rows = [f(task) for task in data]
-
-        return tabulate.tabulate(rows, header)
+        summary = cls.array_summary(task_id)
+
+        if not rows:
+            task = Archiver().find('queue', task_id)
+            if task is not None:
+                array = task.pop('array', None)
+                header = list(task)
+                rows = [f(task)]
+                if array is not None:
+                    summary = {
+                        'task_id': array['task_id'],
+                        'indexes': '{}-{}'.format(array['start'], array['stop']),
+                        'waiting': array['stop'] - array['next_index'] + 1,
+                        'running': array['running'],
+                        'complete': array['complete'],
+                        'canceled': array['canceled'],
+                        'failed': array['failed'],
+                    }
+
+        table = tabulate.tabulate(rows, header)
+        if summary is not None:
+            table += '\n\n' + tabulate.tabulate([summary.values()], summary.keys())
+
+        return table
 
 
     @classmethod
-    def show_abort_queue(cls, mode):
-
-        data = (AbortQueue.select()
-                     .where(AbortQueue.is_waiting == True)
-                     .order_by(AbortQueue.created_at.asc())
+    def show_stats(cls, by_user):
+        """Aggregates the resource usage of the finished tasks."""
+        import tabulate
+        end = peewee.fn.COALESCE(Queue.completed_at, Queue.canceled_at)
+        wall = (peewee.fn.julianday(end) - peewee.fn.julianday(Queue.started_at)) * 86400
+        columns = [
+            peewee.fn.COUNT(Queue.id).alias('tasks'),
+            peewee.fn.SUM(wall).alias('wall'),
+            peewee.fn.SUM(Queue.utime).alias('utime'),
+            peewee.fn.SUM(Queue.stime).alias('stime'),
+            peewee.fn.MAX(Queue.maxrss).alias('peak_maxrss'),
+            peewee.fn.AVG(Queue.maxrss).alias('avg_maxrss'),
+            peewee.fn.SUM(Queue.inblock).alias('inblock'),
+            peewee.fn.SUM(Queue.oublock).alias('oublock'),
+            peewee.fn.SUM(Queue.nvcsw).alias('nvcsw'),
+            peewee.fn.SUM(Queue.nivcsw).alias('nivcsw'),
+        ]
+        header = [column._alias for column in columns]
+        if by_user:
+            columns.insert(0, Queue.user_name)
+            header.insert(0, 'user_name')
+
+        data = (Queue.select(*columns)
+                     .where(Queue.utime.is_null(False))
                      .dicts()
                 )
+        if by_user:
+            data = (data.group_by(Queue.user_id, Queue.user_name)
+                        .order_by(peewee.fn.SUM(Queue.utime + Queue.stime).desc())
+                    )
+
+        rows = [row for row in data if row['tasks']]
 
+        return tabulate.tabulate([row.values() for row in rows], header, floatfmt='.1f')
+
+
+    @classmethod
+    def show_top(cls, samples):
+        """Renders the samples the dispatcher took of the running tasks."""
+        import tabulate
+        tasks = {str(task.id): task
+                 for task in Queue.select().where(Queue.id.in_([int(id) for id in samples]))}
+        percent = lambda value: '-' if value is None else '{:.1f}'.format(value)
+
+        rows = []
+        for task_id, sample in sorted(samples.items(), key=lambda item: int(item[0])):
+            task = tasks.get(task_id)
+            if task is None:
+                continue
+            rows.append([task.id, task.user_name, task.status, percent(sample['cpu']),
+                         percent(sample['avg_cpu']), format_size(sample['rss']),
+                         format_size(sample['peak_rss']), sample['threads'],
+                         task.command[:40]])
+
+        header = ['id', 'user_name', 'status', 'cpu%', 'avg_cpu%', 'rss', 'peak_rss',
+                  'threads', 'command']
+
+        return tabulate.tabulate(rows, header, disable_numparse=True)
+
+
+    @classmethod
+    def get_queue(cls, mode, user_id=None):
+        """The tasks shown by show-queue in the given mode, oldest first."""
+        data = Queue.select().order_by(Queue.created_at.asc())
+
+        # The IDs follow the order the tasks were added in, so the whole
+        # history is read in the order of the table instead of being sorted.
         if mode == 'mine':
-            data = (AbortQueue.select()
-                         .where(AbortQueue.user_id == os.getuid())
-                         .order_by(AbortQueue.created_at.asc())
-                         .dicts()
+            return data.where(Queue.user_id == user_id).order_by(Queue.id.asc())
+        elif mode == 'all':
+            return data.order_by(Queue.id.asc())
+        elif mode == 'done':
+            return data.where(Queue.status == 'complete')
+        elif mode == 'failed':
+            return data.where(Queue.status.in_(['failed', 'oom_killed', 'lost', 'exited']))
+        elif mode == 'blocked':
+            return data.where(Queue.status == 'blocked')
+        elif mode == 'running':
+            return data.where(Queue.status.in_(['running', 'canceling']))
+
+        return data.where(Queue.status == 'waiting')
+
+
+    @classmethod
+    def count_queue(cls, mode, user_id=None, since=None):
+        """The number of rows show-queue has in the given mode."""
+        if mode == 'arrays':
+            return (TaskArray.select()
+                             .join(Queue, on=(TaskArray.task_id == Queue.id))
+                             .where(Queue.status.in_(['waiting', 'running']))
+                             .count()
                     )
 
-        if mode == 'all':
-            data = (AbortQueue.select()
-                         .order_by(AbortQueue.created_at.asc())
-                         .dicts()
+        data = cls.get_queue(mode, user_id).order_by()
+        if since is not None:
+            data = data.where(Queue.created_at >= since)
+
+        return data.count()
+
+
+    @classmethod
+    def select_rows(cls, model, data, limit=None, offset=None, since=None, columns=None):
+        """Narrows a query of show-queue or show-abort-queue to a page and to
+        some columns, returning the header and the function that streams the
+        rows as tuples."""
+        fields = model._meta.fields
+        header = columns or list(fields)
+        unknown = [column for column in header if column not in fields]
+        if unknown:
+            raise ValueError('unknown columns {}, expected some of {}.'.format(
+                ', '.join(unknown), ', '.join(fields)))
+
+        data = data.select(*[fields[column] for column in header])
+        if since is not None:
+            data = data.where(model.created_at >= since)
+        if limit is not None:
+            data = data.limit(limit)
+        if offset:
+            data = data.offset(offset)
+
+        # peewee would parse every date only for it to be printed back, so
+        # the rows come from the cursor with only the booleans converted.
+        booleans = [index for index, column in enumerate(header)
+                    if isinstance(fields[column], peewee.BooleanField)]
+
+        def rows():
+            for row in db.execute(data):
+                if booleans:
+                    row = list(row)
+                    for index in booleans:
+                        if row[index] is not None:
+                            row[index] = bool(row[index])
+                yield row
+
+        return header, rows
+
+
+    @classmethod
+    def show_queue(cls, mode, user_id=None, limit=None, offset=None, since=None,
+                   columns=None, format='table'):
+        """Yields the lines of the queue, streamed from the database so the
+        memory used does not grow with the history."""
+        if user_id is None:
+            user_id = os.getuid()
+
+        if mode == 'arrays':
+            arrays = (TaskArray.select(TaskArray.task_id)
+                        .join(Queue, on=(TaskArray.task_id == Queue.id))
+                        .where(Queue.status.in_(['waiting', 'running']))
+                        .order_by(TaskArray.task_id.asc())
                     )
+            header = ['task_id', 'indexes', 'waiting', 'running', 'complete', 'canceled',
+                      'failed']
+            rows = lambda: (tuple(cls.array_summary(array.task_id).values()) for array in arrays)
+
+            return render(rows, header, format)
+
+        header, rows = cls.select_rows(Queue, cls.get_queue(mode, user_id), limit, offset,
+                                       since, columns)
 
+        return render(rows, header, format)
+
+
+    @classmethod
+    def show_abort_queue(cls, mode, limit=None, offset=None, since=None, columns=None,
+                         format='table'):
+        data = AbortQueue.select().order_by(AbortQueue.created_at.asc())
+
+        if mode == 'mine':
+            data = data.where(AbortQueue.user_id == os.getuid())
         elif mode == 'done':
-             data = (AbortQueue.select()
-                         .where(AbortQueue.is_complete == True)
-                         .order_by(AbortQueue.created_at.asc())
-                         .dicts()
-                    )
+            data = data.where(AbortQueue.is_complete == True)
+        elif mode != 'all':
+            data = data.where(AbortQueue.is_waiting == True)
 
+        header, rows = cls.select_rows(AbortQueue, data, limit, offset, since, columns)
 
-        header = list(AbortQueue._meta.fields.keys())
+        return render(rows, header, format)
 
-        f = lambda x: [str(y) for y in list(x.values())]
-        rows = [f(task) for task in data]
 
-        return tabulate.tabulate(rows, header)
+    @classmethod
+    def charge_usage(cls, task):
+        now = datetime.datetime.now()
+        usage, _ = Usage.get_or_create(user_id=task.user_id)
+        usage.usage = decay(usage.usage, usage.updated_at, now) + get_cpu_seconds(task, now)
+        usage.updated_at = now
+        usage.save()
+
+        return usage.usage
+
+    @classmethod
+    def get_usage(cls):
+        now = datetime.datetime.now()
+        return {usage.user_id: decay(usage.usage, usage.updated_at, now)
+                for usage in Usage.select()}
 
 
     @classmethod
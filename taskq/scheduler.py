@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+import datetime
+from taskq.settings import TASKQ_FAIRSHARE_HALF_LIFE, TASKQ_SHARES, TASKQ_PRIORITY_AGING
+
+
+def get_request(task):
+    return {'cpus': task.cpus or 1, 'mem': task.mem or 0}
+
+
+def get_end(task, now):
+    """Expected end of a running task, None when it has no walltime."""
+    if not task.walltime:
+        return None
+
+    end = (task.started_at or now) + datetime.timedelta(seconds=task.walltime)
+    return max(end, now)
+
+
+def get_priority(task, now):
+    """Priority of a waiting task, raised by its age when aging is enabled."""
+    priority = task.priority or 0
+    if TASKQ_PRIORITY_AGING:
+        age = max((now - task.created_at).total_seconds(), 0)
+        priority += int(age // TASKQ_PRIORITY_AGING)
+
+    return priority
+
+
+def decay(usage, updated_at, now):
+    elapsed = max((now - updated_at).total_seconds(), 0)
+    return usage * 0.5 ** (elapsed / TASKQ_FAIRSHARE_HALF_LIFE)
+
+
+def get_cpu_seconds(task, now):
+    end = task.completed_at or task.canceled_at or now
+    if task.started_at is None:
+        return 0
+
+    return max((end - task.started_at).total_seconds(), 0) * (task.cpus or 1)
+
+
+class Scheduler:
+    def __init__(self, capacity):
+        self.capacity = capacity
+
+    def fits(self, request, free):
+        return all(request[key] <= free[key] for key in request)
+
+    def take(self, request, free):
+        for key in free:
+            free[key] -= request[key]
+
+    def get_free(self, running):
+        free = dict(self.capacity)
+        for task in running:
+            self.take(get_request(task), free)
+
+        return free
+
+    def reserve(self, head, running, free, now):
+        """Finds the shadow time when the head task can start and the resources
+        left over at that moment (EASY backfilling)."""
+        free = dict(free)
+        request = get_request(head)
+        ends = sorted(running, key=lambda task: get_end(task, now) or datetime.datetime.max)
+
+        shadow = now
+        for task in ends:
+            if self.fits(request, free):
+                break
+            shadow = get_end(task, now) or datetime.datetime.max
+            for key, value in get_request(task).items():
+                free[key] += value
+
+        extra = {key: free[key] - request[key] for key in free}
+        return shadow, extra
+
+    def order(self, waiting, usage, running, now=None):
+        """Interleaves the waiting tasks of each user, starting with the user
+        with the lowest normalized usage, within each priority."""
+        now = now or datetime.datetime.now()
+        waiting = {user_id: tasks for user_id, tasks in waiting.items() if tasks}
+        usage = dict(usage)
+        for task in running:
+            usage[task.user_id] = usage.get(task.user_id, 0) + get_cpu_seconds(task, now)
+
+        normalized = lambda user_id: usage.get(user_id, 0) / TASKQ_SHARES.get(user_id, 1)
+        users = sorted(waiting, key=lambda user_id: (normalized(user_id), waiting[user_id][0].created_at))
+
+        ordered = []
+        for position in range(max((len(tasks) for tasks in waiting.values()), default=0)):
+            for user_id in users:
+                if position < len(waiting[user_id]):
+                    ordered.append(waiting[user_id][position])
+
+        # The sort is stable, so the fair-share order is kept between tasks
+        # of the same priority.
+        ordered.sort(key=lambda task: -get_priority(task, now))
+        return ordered
+
+    def preempt(self, head, running, slots, now=None):
+        """Chooses the preemptible running tasks of lower priority than head
+        whose resources let it start, the ones with less work done first.
+        Returns an empty list when head would not fit anyway."""
+        now = now or datetime.datetime.now()
+        priority = get_priority(head, now)
+        candidates = sorted((task for task in running
+                             if task.status == 'running' and task.preemptible
+                             and (task.priority or 0) < priority),
+                            key=lambda task: (task.priority or 0, -(task.started_at or now).timestamp()))
+
+        free = self.get_free(running)
+        request = get_request(head)
+        victims = []
+        for task in candidates:
+            if slots > 0 and self.fits(request, free):
+                break
+            victims.append(task)
+            slots += 1
+            for key, value in get_request(task).items():
+                free[key] += value
+
+        if slots > 0 and self.fits(request, free):
+            return victims
+
+        return []
+
+    def select(self, waiting, running, slots, now=None):
+        """Starts the waiting tasks in queue order. When a task does not fit, it
+        gets a reservation and the later tasks only run ahead of it if they
+        can not delay its start."""
+        now = now or datetime.datetime.now()
+        running = list(running)
+        free = self.get_free(running)
+        selected = []
+        shadow = None
+
+        for task in waiting:
+            if len(selected) >= slots:
+                break
+
+            request = get_request(task)
+            if not self.fits(request, free):
+                if shadow is None:
+                    shadow, extra = self.reserve(task, running, free, now)
+                continue
+
+            if shadow is not None:
+                end = get_end(task, now)
+                if end is None or end > shadow:
+                    if not self.fits(request, extra):
+                        continue
+                    self.take(request, extra)
+
+            selected.append(task)
+            running.append(task)
+            self.take(request, free)
+
+        return selected
@@ -1,3 +1,111 @@
 #!/usr/bin/env python3
 
+# Maximum number of tasks the dispatcher keeps running at the same time.
 TASKQ_SLOTS = 1
+
+# Seconds the dispatcher sleeps between queue checks when it is not woken up
+# through its control socket.
+TASKQ_POLL_INTERVAL = 10
+
+# Capacity shared by the running tasks. None means it is detected from
+# os.cpu_count() and /proc/meminfo. TASKQ_MEM is given in bytes.
+TASKQ_CPUS = None
+TASKQ_MEM = None
+
+# Number of waiting tasks the scheduler looks at on each pass.
+TASKQ_SCHEDULER_WINDOW = 1000
+
+# Fair-share: the next task goes to the user with the lowest recent usage
+# (CPU seconds divided by the user's shares). Usage decays with this half-life,
+# in seconds. Users missing from TASKQ_SHARES have one share.
+TASKQ_FAIRSHARE = True
+TASKQ_FAIRSHARE_HALF_LIFE = 7 * 24 * 3600
+TASKQ_SHARES = {}
+
+# Tasks with a higher --priority start first, fair-share only orders the tasks
+# of the same priority. With TASKQ_PRIORITY_AGING, a waiting task gains one
+# priority level every TASKQ_PRIORITY_AGING seconds, so none starves.
+TASKQ_PRIORITY_AGING = None
+
+# With TASKQ_PREEMPTION, when the first waiting task can not start, running
+# tasks added with --preemptible and a lower priority are terminated as on
+# abort and put back in the queue to free its resources.
+TASKQ_PREEMPTION = False
+
+# SQLite pragmas applied to every connection to the queue database. The 'wal'
+# profile lets many users submit tasks while the dispatcher writes, 'default'
+# keeps the SQLite defaults (rollback journal).
+TASKQ_DB_PROFILE = 'wal'
+TASKQ_DB_PROFILES = {
+    'default': {},
+    'wal': {
+        # Lets the pages freed by the archival be given back bit by bit. It
+        # only applies to a new database if set before the journal mode.
+        'auto_vacuum': 'incremental',
+        'journal_mode': 'wal',
+        'busy_timeout': 5000,
+        'synchronous': 'normal',
+        'cache_size': -64 * 1024,
+        'mmap_size': 256 * 1024 * 1024,
+    },
+}
+
+# Number of rows written by each INSERT of a batch submission.
+TASKQ_INSERT_CHUNK = 1000
+
+# Writes that still find the database locked are retried with exponential
+# backoff, starting at TASKQ_DB_RETRY_DELAY seconds.
+TASKQ_DB_RETRIES = 5
+TASKQ_DB_RETRY_DELAY = 0.1
+
+# Seconds an aborted task has to exit after SIGTERM before its process group
+# is killed with SIGKILL.
+TASKQ_ABORT_GRACE = 10
+
+# The dispatcher samples CPU, memory and threads of the running tasks from
+# /proc every TASKQ_SAMPLE_INTERVAL seconds (None disables it), keeping the
+# last TASKQ_SAMPLE_BUFFER samples of each task for taskq top.
+TASKQ_SAMPLE_INTERVAL = 5
+TASKQ_SAMPLE_BUFFER = 120
+
+# How the --mem and --cpus of a task are enforced: 'cgroup' runs every task in
+# its own cgroup v2 under TASKQ_CGROUP_ROOT (the cgroup of the Task Handler
+# when None), which must be delegated to the queue owner; 'rlimit' limits the
+# address space to --mem; 'auto' uses cgroups when available and rlimits
+# otherwise; None disables limits.
+TASKQ_LIMITS = 'auto'
+TASKQ_CGROUP_ROOT = None
+# With rlimits, also kill tasks whose CPU time exceeds --walltime times --cpus.
+# --walltime is otherwise only an estimate for the scheduler, so this is off.
+TASKQ_CPU_RLIMIT = False
+
+# Seconds before the first retry of a failed task that has --retries left,
+# doubled after every further attempt, unless --retry-backoff is given.
+TASKQ_RETRY_BACKOFF = 60
+
+# The running Task Handler renews its lease every TASKQ_HEARTBEAT seconds. A
+# standby Task Handler takes over once the lease has not been renewed for
+# TASKQ_LEASE_TTL seconds.
+TASKQ_HEARTBEAT = 1
+TASKQ_LEASE_TTL = 5
+
+# What the Task Handler does on start with the tasks left running by a
+# previous one whose process is gone: mark them 'lost' or 'requeue' them.
+# The tasks still alive are adopted, but their exit status is unknown.
+TASKQ_LOST_POLICY = 'lost'
+
+# Tasks and aborts finished more than TASKQ_ARCHIVE_AFTER seconds ago are moved
+# out of the database to monthly gzipped JSON lines files in
+# <taskq home>/archive (None disables it). The Task Handler looks for them
+# every TASKQ_ARCHIVE_INTERVAL seconds and moves at most TASKQ_ARCHIVE_CHUNK
+# rows of each table per pass.
+TASKQ_ARCHIVE_AFTER = 30 * 24 * 3600
+TASKQ_ARCHIVE_INTERVAL = 3600
+TASKQ_ARCHIVE_CHUNK = 1000
+
+# Task output is written to <taskq home>/logs/<task id>.log. The log is rotated
+# when it reaches TASKQ_LOG_MAX_SIZE bytes, keeping TASKQ_LOG_BACKUPS rotated
+# files compressed with 'gzip', 'zstd' (needs the zstandard package) or None.
+TASKQ_LOG_MAX_SIZE = 100 * 1024 * 1024
+TASKQ_LOG_BACKUPS = 5
+TASKQ_LOG_COMPRESSION = 'gzip'
@@ -1,12 +1,7 @@
 #!/usr/bin/env python3
-import os
 import sys
-import time
 import signal
-import click
-import schedule
-from subprocess import Popen
-from taskq.resources import TaskQHelper
+from taskq.dispatcher import Dispatcher
 
 
 def signal_usr1(signum, frame):
@@ -15,26 +10,7 @@ def signal_usr1(signum, frame):
     received = True
 
 
-def job():
-    # click.echo('Calling Task Handler')
-    proc = Popen(['taskq', 'call-task-handler'], stdin=None, stdout=None, stderr=None, close_fds=True)
-    proc.wait()
-
-    return proc.pid
-
-def bot():
-    schedule.every(10).seconds.do(job)
-
-    while 1:
-        # click.echo('Running...')
-        schedule.run_pending()
-        # click.echo('...')
-        time.sleep(1)
-        # click.echo('Done!\n')
-
 received = False
-TaskQHelper.modify_variable('TASK_HANDLER_PID',str(os.getpid()))
-TaskQHelper.modify_variable('TASK_HANDLER_ACTIVE','True')
 signal.signal(signal.SIGUSR1, signal_usr1)
 
-bot()
+Dispatcher().run(standby='--standby' in sys.argv)
@@ -1,13 +1,13 @@
 #!/usr/bin/env python3
 import os
 import pwd
+import json
 import time
 import signal
+import socket
 import taskq
 import pickle
-import tempfile
-from pathlib import Path
-from subprocess import Popen
+from taskq.settings import TASKQ_CPUS, TASKQ_MEM
 
 
 class Configuration:
@@ -57,6 +57,7 @@ class Configuration:
 
 
     def fixPermissions(self):
+        from subprocess import Popen
         for cmd in self.env['permission_fix_cmds']:
             proc = Popen([cmd], shell=True, stdin=None, stdout=None, stderr=None, close_fds=True)
             proc.wait()
@@ -71,15 +72,17 @@ class Configuration:
                         pickle.HIGHEST_PROTOCOL)
 
 
-def start_script(script_file):
+def start_script(script_file, *args):
+    import tempfile
+    from subprocess import Popen
 
     def show_setting_prgrp():
         os.setpgrp()
 
     # try:
     script = '''#!/bin/sh
-    screen -dmS taskq_task_handler bash -c "python3 {}"
-    '''.format(os.path.join(taskq.__path__[0], script_file))
+    screen -dmS taskq_task_handler bash -c "python3 {} {}"
+    '''.format(os.path.join(taskq.__path__[0], script_file), ' '.join(args))
 
     script_file = tempfile.NamedTemporaryFile('wt')
     script_file.write(script)
@@ -96,3 +99,122 @@ def start_script(script_file):
     return True
     # except:
     #     return False
+
+
+def get_socket_path(env):
+    return os.path.join(env['taskq_home_path'], 'taskq.sock')
+
+
+def notify_dispatcher(env, message):
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(1)
+            sock.connect(get_socket_path(env))
+            sock.sendall(json.dumps(message).encode() + b'\n')
+    except OSError:
+        return False
+
+    return True
+
+
+def request_dispatcher(env, message, timeout=30):
+    """Sends a message to the dispatcher and returns its reply. Returns None
+    when the dispatcher is not running, so the caller can do the work itself,
+    and an error reply when the message may have been handled."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        try:
+            sock.connect(get_socket_path(env))
+        except OSError:
+            return None
+
+        try:
+            sock.sendall(json.dumps(message).encode() + b'\n')
+            line = sock.makefile('rb').readline()
+        except OSError:
+            line = None
+
+    if not line:
+        return {'error': 'The Task Handler did not answer.'}
+
+    return json.loads(line)
+
+
+SIZE_UNITS = {'': 1, 'K': 1024, 'M': 1024**2, 'G': 1024**3, 'T': 1024**4}
+
+
+def parse_size(value):
+    value = str(value).strip().upper().rstrip('B')
+    unit = value[-1:] if value[-1:] in SIZE_UNITS else ''
+    number = value[:len(value) - len(unit)]
+
+    return int(float(number) * SIZE_UNITS[unit])
+
+
+def format_size(value):
+    for unit in ('', 'K', 'M', 'G'):
+        if value < 1024 or unit == 'G':
+            break
+        value /= 1024
+
+    return '{:.1f}{}'.format(value, unit) if unit else str(value)
+
+
+def parse_duration(value):
+    value = str(value).strip().lower()
+    if ':' in value:
+        seconds = 0
+        for part in value.split(':'):
+            seconds = seconds * 60 + int(part)
+        return seconds
+
+    units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+    if value[-1:] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+
+    return int(value)
+
+
+def get_capacity():
+    cpus = TASKQ_CPUS or os.cpu_count() or 1
+    mem = TASKQ_MEM
+    if mem is None:
+        with open('/proc/meminfo') as file:
+            for line in file:
+                if line.startswith('MemTotal:'):
+                    mem = int(line.split()[1]) * 1024
+                    break
+
+    return {'cpus': cpus, 'mem': mem or 0}
+
+
+def get_resource_usage(rusage):
+    """Queue columns for the rusage of a finished task, as given by wait4."""
+    return {
+        'utime': rusage.ru_utime,
+        'stime': rusage.ru_stime,
+        # ru_maxrss is in kilobytes on Linux.
+        'maxrss': rusage.ru_maxrss * 1024,
+        'inblock': rusage.ru_inblock,
+        'oublock': rusage.ru_oublock,
+        'nvcsw': rusage.ru_nvcsw,
+        'nivcsw': rusage.ru_nivcsw,
+    }
+
+
+def get_returncode(status):
+    """The returncode of a wait status as Popen sets it, minus the signal for
+    killed processes. os.waitstatus_to_exitcode needs Python 3.9."""
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+
+    return os.WEXITSTATUS(status)
+
+
+def decode_returncode(returncode):
+    """The returncode of a task from the one of its sh wrapper, which exits
+    with 128 plus the signal when the command was killed by one."""
+    if returncode is not None and 128 < returncode < 128 + signal.NSIG:
+        return 128 - returncode
+
+    return returncode
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+import datetime
+import unittest
+from types import SimpleNamespace
+from taskq.scheduler import Scheduler, get_end
+
+NOW = datetime.datetime(2024, 1, 1, 12)
+GB = 1024**3
+
+
+def make_task(task_id, cpus=1, mem=0, walltime=None, priority=0, user_id=1000,
+              status='waiting', preemptible=False, started_at=None, created_at=NOW):
+    return SimpleNamespace(id=task_id, cpus=cpus, mem=mem, walltime=walltime,
+                           priority=priority, user_id=user_id, status=status,
+                           preemptible=preemptible, started_at=started_at,
+                           created_at=created_at, completed_at=None, canceled_at=None)
+
+
+def make_running(task_id, started=0, **kwargs):
+    """A task running since the given number of seconds."""
+    return make_task(task_id, status='running',
+                     started_at=NOW - datetime.timedelta(seconds=started), **kwargs)
+
+
+def ids(tasks):
+    return [task.id for task in tasks]
+
+
+class TestSelect(unittest.TestCase):
+    def setUp(self):
+        self.scheduler = Scheduler({'cpus': 4, 'mem': 8 * GB})
+
+    def test_queue_order_up_to_slots(self):
+        waiting = [make_task(1), make_task(2), make_task(3)]
+        self.assertEqual(ids(self.scheduler.select(waiting, [], 2, NOW)), [1, 2])
+
+    def test_resources(self):
+        waiting = [make_task(1, cpus=3), make_task(2, cpus=2), make_task(3, mem=4 * GB)]
+        self.assertEqual(ids(self.scheduler.select(waiting, [], 3, NOW)), [1, 3])
+
+    def test_backfill_does_not_delay_head(self):
+        running = [make_running(1, cpus=2, walltime=3600)]
+        waiting = [
+            make_task(2, cpus=4),
+            # Ends before the head can start.
+            make_task(3, walltime=600),
+            # Would still hold a CPU the head needs.
+            make_task(4),
+            make_task(5, walltime=7200),
+        ]
+        self.assertEqual(ids(self.scheduler.select(waiting, running, 4, NOW)), [3])
+
+    def test_backfill_in_resources_left_to_head(self):
+        running = [make_running(1, cpus=2, walltime=3600)]
+        waiting = [make_task(2, cpus=3), make_task(3), make_task(4, walltime=7200)]
+        # The head leaves one CPU at its start, which only one task can take.
+        self.assertEqual(ids(self.scheduler.select(waiting, running, 4, NOW)), [3])
+
+    def test_backfill_behind_running_task_without_walltime(self):
+        running = [make_running(1, cpus=2)]
+        waiting = [make_task(2, cpus=4), make_task(3, walltime=7200), make_task(4)]
+        # The head can not be given a start, any task with a walltime ends
+        # before it, the ones without one must not take what it needs.
+        self.assertEqual(ids(self.scheduler.select(waiting, running, 4, NOW)), [3])
+
+
+class TestReserve(unittest.TestCase):
+    def setUp(self):
+        self.scheduler = Scheduler({'cpus': 4, 'mem': 8 * GB})
+
+    def reserve(self, head, running):
+        free = self.scheduler.get_free(running)
+        return self.scheduler.reserve(head, running, free, NOW)
+
+    def test_fits_now(self):
+        shadow, extra = self.reserve(make_task(1, cpus=2), [make_running(2, cpus=2)])
+        self.assertEqual(shadow, NOW)
+        self.assertEqual(extra, {'cpus': 0, 'mem': 8 * GB})
+
+    def test_earliest_ends_first(self):
+        running = [make_running(1, cpus=2, walltime=7200), make_running(2, walltime=3600)]
+        shadow, extra = self.reserve(make_task(3, cpus=2, mem=GB), running)
+        self.assertEqual(shadow, NOW + datetime.timedelta(hours=1))
+        self.assertEqual(extra, {'cpus': 0, 'mem': 7 * GB})
+
+    def test_end_from_start(self):
+        running = [make_running(1, started=1800, cpus=4, walltime=3600)]
+        shadow, _ = self.reserve(make_task(2), running)
+        self.assertEqual(shadow, NOW + datetime.timedelta(minutes=30))
+
+    def test_overdue_task_ends_now(self):
+        running = [make_running(1, started=7200, cpus=4, walltime=3600)]
+        self.assertEqual(get_end(running[0], NOW), NOW)
+        shadow, _ = self.reserve(make_task(2), running)
+        self.assertEqual(shadow, NOW)
+
+    def test_running_task_without_walltime(self):
+        running = [make_running(1, cpus=3), make_running(2, walltime=3600)]
+        shadow, extra = self.reserve(make_task(3, cpus=4), running)
+        self.assertEqual(shadow, datetime.datetime.max)
+        self.assertEqual(extra, {'cpus': 0, 'mem': 8 * GB})
+
+
+class TestOrder(unittest.TestCase):
+    def setUp(self):
+        self.scheduler = Scheduler({'cpus': 4, 'mem': 8 * GB})
+
+    def test_lowest_usage_first(self):
+        waiting = {
+            1: [make_task(1, user_id=1), make_task(2, user_id=1)],
+            2: [make_task(3, user_id=2), make_task(4, user_id=2)],
+        }
+        ordered = self.scheduler.order(waiting, {1: 100, 2: 0}, [], NOW)
+        self.assertEqual(ids(ordered), [3, 1, 4, 2])
+
+    def test_same_usage_oldest_first(self):
+        later = NOW + datetime.timedelta(seconds=1)
+        waiting = {
+            1: [make_task(1, user_id=1, created_at=later)],
+            2: [make_task(2, user_id=2)],
+        }
+        self.assertEqual(ids(self.scheduler.order(waiting, {}, [], NOW)), [2, 1])
+
+    def test_running_tasks_count_as_usage(self):
+        waiting = {1: [make_task(1, user_id=1)], 2: [make_task(2, user_id=2)]}
+        running = [make_running(3, started=3600, user_id=1)]
+        self.assertEqual(ids(self.scheduler.order(waiting, {2: 60}, running, NOW)), [2, 1])
+
+    def test_priority_before_usage(self):
+        waiting = {
+            1: [make_task(1, user_id=1, priority=1), make_task(2, user_id=1)],
+            2: [make_task(3, user_id=2), make_task(4, user_id=2)],
+        }
+        # Tasks of the same priority keep the fair-share order.
+        ordered = self.scheduler.order(waiting, {1: 100}, [], NOW)
+        self.assertEqual(ids(ordered), [1, 3, 4, 2])
+
+    def test_users_without_tasks(self):
+        waiting = {1: [], 2: [make_task(1, user_id=2)]}
+        self.assertEqual(ids(self.scheduler.order(waiting, {}, [], NOW)), [1])
+
+
+class TestPreempt(unittest.TestCase):
+    def setUp(self):
+        self.scheduler = Scheduler({'cpus': 4, 'mem': 8 * GB})
+
+    def test_least_work_done_first(self):
+        running = [
+            make_running(1, started=7200, cpus=2, preemptible=True),
+            make_running(2, started=600, cpus=2, preemptible=True),
+        ]
+        head = make_task(3, cpus=2, priority=5)
+        self.assertEqual(ids(self.scheduler.preempt(head, running, 2, NOW)), [2])
+
+    def test_lowest_priority_first(self):
+        running = [
+            make_running(1, started=7200, cpus=2, priority=0, preemptible=True),
+            make_running(2, started=600, cpus=2, priority=1, preemptible=True),
+        ]
+        head = make_task(3, cpus=2, priority=5)
+        self.assertEqual(ids(self.scheduler.preempt(head, running, 2, NOW)), [1])
+
+    def test_only_lower_priority_and_preemptible(self):
+        running = [
+            make_running(1, cpus=2, priority=5, preemptible=True),
+            make_running(2, cpus=1),
+            make_running(3, cpus=1, preemptible=True),
+        ]
+        head = make_task(4, cpus=2, priority=5)
+        self.assertEqual(ids(self.scheduler.preempt(head, running, 1, NOW)), [])
+
+    def test_frees_a_slot(self):
+        running = [make_running(1, preemptible=True)]
+        head = make_task(2, priority=1)
+        self.assertEqual(ids(self.scheduler.preempt(head, running, 0, NOW)), [1])
+
+    def test_canceling_tasks_are_not_preempted(self):
+        running = [make_running(1, cpus=4, preemptible=True)]
+        running[0].status = 'canceling'
+        head = make_task(2, priority=1)
+        self.assertEqual(ids(self.scheduler.preempt(head, running, 1, NOW)), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
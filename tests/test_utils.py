@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+import unittest
+from taskq.utils import parse_size, parse_duration, format_size
+
+
+class TestParseSize(unittest.TestCase):
+    def test_bytes(self):
+        self.assertEqual(parse_size('512'), 512)
+        self.assertEqual(parse_size(512), 512)
+        self.assertEqual(parse_size('10B'), 10)
+
+    def test_units(self):
+        self.assertEqual(parse_size('1K'), 1024)
+        self.assertEqual(parse_size('2mb'), 2 * 1024**2)
+        self.assertEqual(parse_size(' 4g '), 4 * 1024**3)
+        self.assertEqual(parse_size('1T'), 1024**4)
+
+    def test_fractions(self):
+        self.assertEqual(parse_size('1.5G'), 3 * 1024**3 // 2)
+
+    def test_invalid(self):
+        for value in ('', 'G', 'abc', '1X'):
+            with self.subTest(value=value):
+                self.assertRaises(ValueError, parse_size, value)
+
+
+class TestParseDuration(unittest.TestCase):
+    def test_seconds(self):
+        self.assertEqual(parse_duration('90'), 90)
+        self.assertEqual(parse_duration(90), 90)
+        self.assertEqual(parse_duration('30s'), 30)
+
+    def test_units(self):
+        self.assertEqual(parse_duration('10M'), 600)
+        self.assertEqual(parse_duration('1.5h'), 5400)
+        self.assertEqual(parse_duration('2d'), 2 * 86400)
+
+    def test_clock(self):
+        self.assertEqual(parse_duration('1:30'), 90)
+        self.assertEqual(parse_duration('1:00:00'), 3600)
+
+    def test_invalid(self):
+        for value in ('', 'x', '1w', '1:x'):
+            with self.subTest(value=value):
+                self.assertRaises(ValueError, parse_duration, value)
+
+
+class TestFormatSize(unittest.TestCase):
+    def test_format(self):
+        self.assertEqual(format_size(512), '512')
+        self.assertEqual(format_size(1536), '1.5K')
+        self.assertEqual(format_size(3 * 1024**3), '3.0G')
+        self.assertEqual(format_size(2 * 1024**4), '2048.0G')
+
+
+if __name__ == '__main__':
+    unittest.main()